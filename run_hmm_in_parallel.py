@@ -0,0 +1,101 @@
+import os
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+#
+from utils.helpers import *
+
+# Import relevant SBL surprise regressor modules
+import sbl_agents.sbl_hmm as sbl_hmm
+
+# General Model Settings
+model_types = ["SP", "AP", "TP"]
+catch_settings = [False, True]
+template = "Subject {} | Block {} | Model: {} | Catch: {} | Time: {:.2f}"
+
+
+def run_hmm_setting(setting):
+    # Worker: one HMM learner (model type x catch) on one block - failures
+    # are returned instead of raised so that the other settings are kept
+    (subject_id, block_id, seq, hidden, model_type, catch,
+     n_states, fix_tm, order, online, max_iter, output) = setting
+    start = time.time()
+    try:
+        agent = sbl_hmm.SBL_HMM(seq, hidden, n_states, model_type, fix_tm, catch,
+                                order, False, online=online, max_iter=max_iter,
+                                output=output)
+        results = agent.compute_surprisal(False, agent.T)
+    except Exception as error:
+        print(template.format(subject_id+1, block_id+1, model_type, catch,
+                              time.time() - start) + " | Failed: {!r}".format(error))
+        return None, repr(error)
+    print(template.format(subject_id+1, block_id+1, model_type, catch,
+                          time.time() - start))
+    return results, None
+
+
+def main(subject_id, n_states, fix_tm, order, online, max_iter, output,
+         n_jobs, results_dir=results_dir):
+    # Load in the trial/stimuli sequences of all blocks once
+    blocks = []
+    for block_id in range(len(sample_files[subject_id])):
+        sample, meta = load_obj("data/" + sample_files[subject_id][block_id] + ".mat")
+        blocks.append((sample[:, 2], sample[:, 1]))
+
+    # All blocks x model types x catch settings run concurrently
+    settings = [(subject_id, block_id, seq, hidden, model_type, catch,
+                 n_states, fix_tm, order, online, max_iter, output)
+                for block_id, (seq, hidden) in enumerate(blocks)
+                for model_type in model_types for catch in catch_settings]
+    with Pool(n_jobs) as pool:
+        all_results = pool.map(run_hmm_setting, settings, chunksize=1)
+
+    # Single .mat results file (save_obj) - one entry of named columns per
+    # setting, failed settings are reported and left out
+    results_formatted = {}
+    failed = []
+    for setting, (results, error) in zip(settings, all_results):
+        block_id, model_type, catch = setting[1], setting[4], setting[5]
+        title = "block_{}_{}_{}".format(block_id + 1, model_type,
+                                        "catch" if catch else "no_catch")
+        if error is not None:
+            failed.append("{}: {}".format(title, error))
+            continue
+        results_formatted[title] = {name: results[name] for name in results.dtype.names}
+
+    if failed:
+        print("{} of {} settings failed:".format(len(failed), len(settings)))
+        for line in failed:
+            print("    " + line)
+
+    title = "HMM_subject_" + str(subject_id + 1)
+    save_obj(results_formatted, results_dir + title)
+    print("Saved in File: {}".format(results_dir + title + ".mat"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s_id', '--subject_id', action="store",
+                        default=0, type=int,
+                        help="Subject for which all blocks are processed")
+    parser.add_argument('-states', '--n_states', action="store",
+                        default=2, type=int,
+                        help='Number of Hidden States in HMM')
+    parser.add_argument('-fix_tm', '--fixed_tm', action="store", default=1,
+                        type=int, help='Freely estimated (0) or Fixed (1) transition matrix')
+    parser.add_argument('-order', '--order_TP', action="store", default=1, type=int,
+                        help='Order for Transition Probability model')
+    parser.add_argument('-online', '--online', action="store_true", default=False,
+                        help='Forward-filtering learner with stepwise EM (no refits)')
+    parser.add_argument('-max_iter', '--max_iter', action="store", default=20000,
+                        type=int, help='EM iteration budget per trial')
+    parser.add_argument('-output', '--output', action="store", default="surprise",
+                        type=str, help='Stored columns (surprise, posteriors, full)')
+    parser.add_argument('-jobs', '--n_jobs', action="store", default=os.cpu_count(),
+                        type=int, help='Number of worker processes')
+    args = parser.parse_args()
+
+    main(args.subject_id, args.n_states, args.fixed_tm, args.order_TP,
+         args.online, args.max_iter, args.output, args.n_jobs)
@@ -20,16 +20,6 @@ model_types = ["SP", "AP", "TP"]
 save_results = True
 verbose = True
 
-sample_files = [["sub-01/sub-01_ses-1_run-1", "sub-01/sub-01_ses-1_run-2",
-                 "sub-01/sub-01_ses-1_run-3", "sub-01/sub-01_ses-1_run-4",
-                 "sub-01/sub-01_ses-1_run-5"],
-                ["sub-02/sub-02_ses-1_run-1", "sub-02/sub-02_ses-1_run-2",
-                 "sub-02/sub-02_ses-1_run-3", "sub-02/sub-02_ses-1_run-4",
-                 "sub-02/sub-02_ses-1_run-5"],
-                ["sub-04/sub-04_ses-1_run-1", "sub-04/sub-04_ses-1_run-2",
-                 "sub-04/sub-04_ses-1_run-3", "sub-04/sub-04_ses-1_run-4",
-                 "sub-04/sub-04_ses-1_run-5"]]
-
 eeg_files = ["sub-01/sub-01_sbl"]
 subject_list = range(len(eeg_files))
 
@@ -54,24 +44,23 @@ def main(subject_id, eoi, inter_stim_interval, sampling_rate,
     # Load in the EEG data
     eeg_data = sio.loadmat("data/" + eeg_files[subject_id] + ".mat")
 
-    # Loop over BLOCKS
+    # Load in the trial/stimuli sequences of all blocks
+    seqs = []
     for block_id in range(len(sample_files[subject_id])):
-        # Load in the specific trial/stimuli sequence
         sample, meta = load_obj("data/" + sample_files[subject_id][block_id] + ".mat")
-        seq, hidden = sample[:, 2], sample[:, 1]
+        seqs.append(sample[:, 2])
 
-        # Compute Surprise Regressors
-        CD_PS_SP, CD_BS_SP, CD_CS_SP = sbl_cd.main(seq, hidden, tau=0,
-                                                   model_type="SP")
-        CD_PS_AP, CD_BS_AP, CD_CS_AP = sbl_cd.main(seq, hidden, tau=0,
-                                                   model_type="AP")
-        CD_PS_TP, CD_BS_TP, CD_CS_TP = sbl_cd.main(seq, hidden, tau=0,
-                                                   model_type="TP")
+    # Compute SP/AP/TP Surprise Regressors for all blocks in a single sweep
+    seqs_padded = sbl_cd.pad_sequences(seqs)[0]
+    CD_regressors = sbl_cd.compute_surprisal_fused(seqs_padded, tau=0, order=1)
 
+    # Loop over BLOCKS
+    for block_id in range(len(sample_files[subject_id])):
+        T = len(seqs[block_id])
         # Define dictionary of regressors with which to run analysis
-        regressors = {"CD_PS_SP": CD_PS_SP, "CD_BS_SP": CD_BS_SP,
-                      "CD_PS_AP": CD_PS_AP, "CD_BS_AP": CD_BS_AP,
-                      "CD_PS_TP": CD_PS_TP, "CD_BS_TP": CD_BS_TP}
+        regressors = {"CD_" + reg: CD_regressors[reg][block_id, :T]
+                      for reg in ["PS_SP", "BS_SP", "PS_AP", "BS_AP",
+                                  "PS_TP", "BS_TP"]}
 
         # Loop over ELECTRODES OF INTEREST
         for elec_name, elec_id in eoi.items():
@@ -0,0 +1,131 @@
+import os
+import time
+import argparse
+import itertools
+import numpy as np
+import h5py
+from multiprocessing import Pool
+
+from sampling.seq_gen import seq_gen
+from utils.helpers import *
+
+
+def seed_stream(root_seed, param_id, seed_id):
+    """
+    Independent random stream of one (parameter set, seed) cell of the bank
+        * The stream only depends on the root seed and the cell index, so the
+          bank is bit-identical regardless of worker count and order
+    """
+    seed_seq = np.random.SeedSequence(root_seed, spawn_key=(param_id, seed_id))
+    return np.random.Generator(np.random.PCG64(seed_seq))
+
+
+def generate_cell(setting):
+    # Worker: sample all sequences of one (parameter set, seed) cell
+    (param_id, seed_id, root_seed, order, prob_catch, prob_regime_init,
+     prob_regime_change, prob_obs_init, prob_obs_change,
+     n_sequences, seq_length) = setting
+    gen_temp = seq_gen(order, prob_catch, prob_regime_init, prob_regime_change,
+                       prob_obs_init, prob_obs_change, False)
+    rng = seed_stream(root_seed, param_id, seed_id)
+    return param_id, seed_id, gen_temp.sample_batch(n_sequences, seq_length, rng)
+
+
+def main(order, prob_catch_grid, prob_regime_init, prob_regime_change_grid,
+         prob_obs_init, prob_obs_change, n_seeds, n_sequences, seq_length,
+         root_seed, n_jobs, title, verbose=False):
+    """
+    Generate a bank of sequences for a grid of parameter sets
+        * Every (parameter set, seed) cell gets its own SeedSequence stream
+        * Cells are sampled in a process pool and written to one HDF5 file
+    OUTPUT: results_dir + title + ".hdf5" with dataset "sequences" of shape
+    (n_param_sets x n_seeds x n_sequences x seq_length x 3) - chunked per
+    cell - and the parameter grid as datasets/attributes
+    """
+    param_grid = list(itertools.product(prob_regime_change_grid, prob_catch_grid))
+    settings = [(param_id, seed_id, root_seed, order, prob_catch,
+                 prob_regime_init, prob_regime_change, prob_obs_init,
+                 prob_obs_change, n_sequences, seq_length)
+                for param_id, (prob_regime_change, prob_catch) in enumerate(param_grid)
+                for seed_id in range(n_seeds)]
+
+    fname = results_dir + title + ".hdf5"
+    with h5py.File(fname, "w") as h5f:
+        bank = h5f.create_dataset("sequences",
+                                  (len(param_grid), n_seeds, n_sequences, seq_length, 3),
+                                  dtype=float, chunks=(1, 1, n_sequences, seq_length, 3),
+                                  compression="gzip")
+        h5f.create_dataset("prob_regime_change", data=[p[0] for p in param_grid])
+        h5f.create_dataset("prob_catch", data=[p[1] for p in param_grid])
+        h5f.attrs["root_seed"] = root_seed
+        h5f.attrs["order"] = order
+        h5f.attrs["prob_regime_init"] = prob_regime_init
+        h5f.attrs["prob_obs_init"] = prob_obs_init
+        h5f.attrs["prob_obs_change"] = prob_obs_change
+
+        start = time.time()
+        with Pool(n_jobs) as pool:
+            for param_id, seed_id, samples in pool.imap_unordered(generate_cell, settings):
+                # Catch trials are stored as 2 as in seq_gen.save
+                samples[samples[:, :, 2] == 0.5, 2] = 2
+                bank[param_id, seed_id] = samples
+                if verbose:
+                    print("Param Set {} | Seed {} | Time: {:.2f}".format(param_id + 1, seed_id + 1,
+                                                                         time.time() - start))
+    print("Saved in File: {}".format(fname))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-reg_init', '--prob_regime_init', action="store",
+                        default=0.5, type=float,
+                        help="Initial regime probability")
+    parser.add_argument('-reg_change', '--prob_regime_change', nargs='+',
+                        default=[0.01], type=float,
+                        help="Probabilities of changing regime (grid)")
+    parser.add_argument('-obs_init', '--prob_obs_init', action="store",
+                        default=0.5, type=float,
+                        help="Initial observation probability")
+    parser.add_argument('-obs_change', '--prob_obs_change', nargs='+',
+                        help="Probability of sampling observations",
+                        action="store", type=float, required=True)
+    parser.add_argument('-catch', '--prob_catch', nargs='+',
+                        default=[0.05], type=float,
+                        help="Probabilities of catch trials (grid)")
+    parser.add_argument('-order', '--markov_order', action="store",
+                        default=1, type=int,
+                        help='Markov dependency on observation level')
+    parser.add_argument('-seeds', '--n_seeds', action="store",
+                        default=10, type=int,
+                        help='Number of seeds per parameter set')
+    parser.add_argument('-n_seq', '--n_sequences', action="store",
+                        default=100, type=int,
+                        help='Number of sequences per parameter set and seed')
+    parser.add_argument('-seq', '--sequence_length', action="store",
+                        default=200, type=int,
+                        help='Length of binary sequence being processed')
+    parser.add_argument('-root', '--root_seed', action="store",
+                        default=1234, type=int,
+                        help='Root seed from which all streams are spawned')
+    parser.add_argument('-jobs', '--n_jobs', action="store",
+                        default=os.cpu_count(), type=int,
+                        help='Number of worker processes')
+    parser.add_argument('-t', '--title', action="store",
+                        default="sequence_bank", type=str,
+                        help='Title of file which stores the bank')
+    parser.add_argument('-v', '--verbose',
+                        action="store_true",
+                        default=False,
+                        help='Get status printed out')
+    args = parser.parse_args()
+
+    prob_regime_init = np.array([args.prob_regime_init, 1-args.prob_regime_init])
+    prob_obs_init = np.array([args.prob_obs_init, 1-args.prob_obs_init, 0])
+
+    main(args.markov_order, args.prob_catch, prob_regime_init,
+         args.prob_regime_change, prob_obs_init, args.prob_obs_change,
+         args.n_seeds, args.n_sequences, args.sequence_length,
+         args.root_seed, args.n_jobs, args.title, args.verbose)
+    """
+    python -m sampling.gen_seq_bank -obs_change 0.45 0.45 0.05 0.05 -reg_change 0.01 0.02 -seeds 10 -n_seq 100 -seq 800
+    """
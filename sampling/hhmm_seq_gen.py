@@ -0,0 +1,303 @@
+import numpy as np
+
+import argparse
+from bisect import bisect_right
+
+from utils.helpers import *
+
+
+class hhmm_seq_gen():
+    """
+    DESCRIPTION:
+        * Generative model to sample sequences of K categorical observations
+          from R hidden regimes with n-th order Markov emissions
+        * The regime follows a Markov chain, the observation is drawn from the
+          emission row of the active regime and the last n (non-catch) obs
+        * Catch trials are an optional overlay - with prob_catch a trial is
+          replaced by the catch symbol K (hidden state R) and is skipped by
+          the context of later trials
+    INPUT:
+        * emissions: (R x K^n x K) tensor - emissions[r, c, k] = p(o_t=k|s_t=r, c)
+          where the context row c = sum_j o_{t-j} K^(n-j) (most recent obs is
+          the most significant digit - as the rows of seq_gen)
+        * regime_transitions: (R x R) regime transition matrix
+        * prob_regime_init: Initial probability vector for hidden state (R)
+        * prob_obs_init: Probability vector of the first n observations (K)
+        * prob_catch: Probability of a catch trial
+    OUTPUT:
+        * sample: A sequence of observed states with length t
+    """
+    def __init__(self, emissions, regime_transitions, prob_regime_init,
+                 prob_obs_init, prob_catch=0., verbose=False):
+        self.emissions = np.asarray(emissions, dtype=float)
+        self.regime_transitions = np.asarray(regime_transitions, dtype=float)
+        self.prob_regime_init = np.asarray(prob_regime_init, dtype=float)
+        self.prob_obs_init = np.asarray(prob_obs_init, dtype=float)
+        self.prob_catch = float(prob_catch)
+        self.verbose = verbose
+
+        # Dimensions of regime, observation and context space
+        if self.emissions.ndim != 3:
+            raise ValueError("Emission tensor needs shape (R x K^n x K)")
+        self.regime_space, n_rows, self.obs_space = self.emissions.shape
+        if self.obs_space < 2:
+            raise ValueError("Need at least 2 observation symbols")
+        self.order = int(round(np.log(n_rows)/np.log(self.obs_space)))
+
+        # Check consistency of the inputs and precompute the sampling tables
+        self.check_input_dim()
+        self.construct_tables()
+
+    def check_input_dim(self):
+        # Function checks if the input parameters conform with required shapes
+        R, K = self.regime_space, self.obs_space
+        if self.emissions.shape[1] != K**self.order:
+            raise ValueError("Emission tensor needs shape (R x K^n x K)")
+        elif self.regime_transitions.shape != (R, R):
+            raise ValueError("Regime transition matrix needs shape ({} x {})".format(R, R))
+        elif len(self.prob_regime_init) != R:
+            raise ValueError("Initial regime prob vector has wrong dim")
+        elif len(self.prob_obs_init) != K:
+            raise ValueError("Initial obs prob vector has wrong dim")
+        elif self.prob_catch > 1 or self.prob_catch < 0:
+            raise ValueError("Catch probability has to be a float between 0 and 1")
+        for probs in [self.emissions, self.regime_transitions,
+                      self.prob_regime_init, self.prob_obs_init]:
+            if (probs < 0).any() or not np.allclose(probs.sum(axis=-1), 1):
+                raise ValueError("Matrices are not row stochastic")
+        if self.verbose:
+            print("All input arrays conform with the specified dimensions.")
+
+    def construct_tables(self):
+        """
+        Cumulative tables of all rows laid out back to back - row i occupies
+        (i, i+1], so a draw from row i is searchsorted(table, i + u) - i*width
+        and rows of different sequences are sampled in a single call
+        """
+        def offset_table(rows):
+            cumulative = np.cumsum(rows, axis=1)
+            cumulative /= cumulative[:, -1:]
+            return (cumulative + np.arange(rows.shape[0])[:, np.newaxis]).ravel()
+
+        # Emission rows get the catch symbol K as additional column
+        rows = self.emissions.reshape(-1, self.obs_space)
+        rows = np.hstack(((1 - self.prob_catch)*rows,
+                          np.full((rows.shape[0], 1), self.prob_catch)))
+        self.cum_emissions = offset_table(rows)
+        self.cum_regimes = offset_table(self.regime_transitions)
+        self.cum_regime_init = offset_table(self.prob_regime_init[np.newaxis])
+        self.cum_obs_init = offset_table(self.prob_obs_init[np.newaxis])
+
+        if self.verbose:
+            print("HHMM correctly initialized. Ready to Sample.")
+            print("--------------------------------------------")
+            print("{} regimes, {} symbols, order {}, catch prob {}".format(
+                  self.regime_space, self.obs_space, self.order, self.prob_catch))
+            print("--------------------------------------------")
+
+    def sample(self, seq_length, rng=None):
+        """
+        INPUT:
+            * seq_length: Length of desired observed sequence
+            * rng: Random generator - global NumPy state if None
+        OUTPUT:
+            * sample: (t x 3) array: index, hidden, observed
+        """
+        self.sample_seq = self.sample_batch(1, seq_length, rng)[0]
+        return self.sample_seq
+
+    def sample_batch(self, n_sequences, seq_length, rng=None):
+        """
+        INPUT:
+            * n_sequences: Number of independent sequences
+            * seq_length: Length of each observed sequence
+            * rng: Random generator (np.random.RandomState/Generator) - global
+              NumPy state if None
+        OUTPUT:
+            * samples: (n_sequences x t x 3) array: index, hidden, observed
+              - catch trials have hidden state R and observation K
+        """
+        chunks = self.sample_chunks(n_sequences, seq_length, max(seq_length, 1), rng)
+        return np.concatenate(list(chunks) or [np.zeros((n_sequences, 0, 3))], axis=1)
+
+    def sample_chunks(self, n_sequences, seq_length, chunk_size, rng=None):
+        """
+        INPUT:
+            * n_sequences, seq_length, rng: As in sample_batch
+            * chunk_size: Number of trials per yielded chunk
+        OUTPUT:
+            * Generator of (n_sequences x chunk_size x 3) arrays (last chunk
+              may be shorter) - concatenated they equal sample_batch
+        DESCRIPTION:
+            All sequences are advanced in lockstep - every trial costs one
+            searchsorted for the regimes and one for the observations. Active
+            regime and context row are carried over between chunks. A single
+            sequence is sampled by sample_chunks_single without per-trial
+            array overhead.
+        """
+        rng = np.random if rng is None else rng
+        if n_sequences == 1:
+            yield from self.sample_chunks_single(seq_length, chunk_size, rng)
+            return
+        R, K, n = self.regime_space, self.obs_space, self.order
+        n_rows, width = K**n, K + 1
+
+        # Initial regime - context row starts at 0 and is filled by the first n obs
+        regime = np.searchsorted(self.cum_regime_init, rng.uniform(size=n_sequences), side="right")
+        context = np.zeros(n_sequences, dtype=int)
+
+        for start in range(0, seq_length, chunk_size):
+            stop = min(start + chunk_size, seq_length)
+            Q = np.zeros((n_sequences, stop - start, 2), dtype=int)
+
+            for t in range(start, stop):
+                if t > 0:
+                    u = regime + rng.uniform(size=n_sequences)
+                    regime = np.searchsorted(self.cum_regimes, u, side="right") - regime*R
+
+                if t < n:
+                    obs = np.searchsorted(self.cum_obs_init, rng.uniform(size=n_sequences), side="right")
+                else:
+                    row = regime*n_rows + context
+                    u = row + rng.uniform(size=n_sequences)
+                    obs = np.searchsorted(self.cum_emissions, u, side="right") - row*width
+
+                Q[:, t - start, 0] = regime
+                Q[:, t - start, 1] = obs
+
+                # Shift non-catch obs into the context row: c' = o_t K^(n-1) + c // K
+                no_catch = obs != K
+                context[no_catch] = obs[no_catch]*(n_rows // K) + context[no_catch] // K
+
+            # Switch hidden state to R if catch trial is sampled
+            Q[Q[:, :, 1] == K, 0] = R
+
+            # Add column with trial/obs/time
+            time = np.broadcast_to(np.arange(start, stop), (n_sequences, stop - start))
+            yield np.concatenate((time[:, :, np.newaxis], Q), axis=2).astype(float)
+
+    def sample_chunks_single(self, seq_length, chunk_size, rng):
+        """
+        Scalar counterpart of sample_chunks for a single sequence
+            * Draws are bisections of the same offset tables - the scalar
+              searchsorted - so the output equals sample_chunks with
+              n_sequences=1
+            * Uniforms are drawn a chunk at a time and consumed in the order
+              of the batch path
+        """
+        R, K, n = self.regime_space, self.obs_space, self.order
+        n_rows, width = K**n, K + 1
+        cum_emissions = self.cum_emissions.tolist()
+        cum_regimes = self.cum_regimes.tolist()
+        cum_obs_init = self.cum_obs_init.tolist()
+
+        regime = int(np.searchsorted(self.cum_regime_init, rng.uniform(size=1), side="right")[0])
+        context = 0
+
+        uniforms, pos = [], 0
+        for start in range(0, seq_length, chunk_size):
+            stop = min(start + chunk_size, seq_length)
+            if len(uniforms) - pos < 2*(stop - start):
+                uniforms, pos = uniforms[pos:] + rng.uniform(size=2*chunk_size).tolist(), 0
+            hidden, observed = [], []
+
+            for t in range(start, stop):
+                if t > 0:
+                    regime = bisect_right(cum_regimes, regime + uniforms[pos]) - regime*R
+                    pos += 1
+
+                if t < n:
+                    obs = bisect_right(cum_obs_init, uniforms[pos])
+                else:
+                    row = regime*n_rows + context
+                    obs = bisect_right(cum_emissions, row + uniforms[pos]) - row*width
+                pos += 1
+
+                hidden.append(regime)
+                observed.append(obs)
+                # Shift non-catch obs into the context row
+                if obs != K:
+                    context = obs*(n_rows // K) + context // K
+
+            Q = np.column_stack((np.arange(start, stop), hidden, observed))
+            # Switch hidden state to R if catch trial is sampled
+            Q[Q[:, 2] == K, 1] = R
+            yield Q[np.newaxis].astype(float)
+
+
+def binary_emissions(prob_obs_change, order):
+    """
+    Emission tensor of the 2-regime binary model from the p(o_t=0|context)
+    parametrization of seq_gen (first 2^n probs regime 0, then regime 1)
+    """
+    prob_zero = np.asarray(prob_obs_change, dtype=float).reshape(2, 2**order)
+    return np.stack((prob_zero, 1 - prob_zero), axis=2)
+
+
+def stream_and_save(hhmm_gen_temp, seq_length, chunk_size, title, rng=None):
+    """
+    Sample a sequence chunk by chunk and append every chunk to a resizable
+    HDF5 dataset - memory is bounded by the chunk size
+    """
+    attrs = {key: getattr(hhmm_gen_temp, key) for key in
+             ["emissions", "regime_transitions", "prob_regime_init",
+              "prob_obs_init", "prob_catch", "order"]}
+    chunks = hhmm_gen_temp.sample_chunks(1, seq_length, chunk_size, rng)
+    save_chunks(chunks, results_dir + title, min(chunk_size, seq_length), attrs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-K', '--n_symbols', action="store",
+                        default=2, type=int,
+                        help="Number of observation symbols")
+    parser.add_argument('-R', '--n_regimes', action="store",
+                        default=2, type=int,
+                        help="Number of hidden regimes")
+    parser.add_argument('-order', '--markov_order', action="store",
+                        default=1, type=int,
+                        help='Markov dependency on observation level')
+    parser.add_argument('-emissions', '--emissions', nargs='+',
+                        action="store", type=float,
+                        help="Flattened (R x K^n x K) emission tensor")
+    parser.add_argument('-obs_change', '--prob_obs_change', nargs='+',
+                        action="store", type=float,
+                        help="Binary model: p(o_t=0|context) as in seq_gen.py")
+    parser.add_argument('-reg_change', '--prob_regime_change', action="store",
+                        default=0.01, type=float,
+                        help="Probability of changing regime (uniform over the others)")
+    parser.add_argument('-catch', '--prob_catch', action="store",
+                        default=0.05, type=float,
+                        help="Probability of catch trials")
+    parser.add_argument('-seq', '--sequence_length', action="store",
+                        default=200, type=int,
+                        help='Length of sequence being processed')
+    parser.add_argument('-chunk', '--chunk_size', action="store",
+                        default=100000, type=int,
+                        help='Number of trials sampled and written at once')
+    parser.add_argument('-t', '--title', action="store",
+                        default="temporary_sample_title", type=str,
+                        help='Title of file which stores sequence')
+    parser.add_argument('-v', '--verbose',
+                        action="store_true",
+                        default=False,
+                        help='Get status printed out')
+    args = parser.parse_args()
+
+    R, K = args.n_regimes, args.n_symbols
+    if args.emissions is not None:
+        emissions = np.reshape(args.emissions, (R, K**args.markov_order, K))
+    else:
+        emissions = binary_emissions(args.prob_obs_change, args.markov_order)
+
+    # Stay with 1 - reg_change, switch uniformly to any other regime
+    regime_transitions = np.full((R, R), args.prob_regime_change/max(R - 1, 1))
+    np.fill_diagonal(regime_transitions, 1 - args.prob_regime_change)
+
+    gen_temp = hhmm_seq_gen(emissions, regime_transitions, np.ones(R)/R,
+                            np.ones(K)/K, args.prob_catch, args.verbose)
+    stream_and_save(gen_temp, args.sequence_length, args.chunk_size, args.title)
+    """
+    python -m sampling.hhmm_seq_gen -obs_change 0.35 0.65 0.65 0.35 -order 1 -seq 800 -t hhmm_temp
+    python -m sampling.hhmm_seq_gen -K 3 -R 3 -order 1 -emissions 0.8 0.1 0.1 0.1 0.8 0.1 0.1 0.1 0.8 0.1 0.8 0.1 0.1 0.1 0.8 0.8 0.1 0.1 0.1 0.1 0.8 0.8 0.1 0.1 0.1 0.8 0.1 -seq 800
+    """
@@ -98,48 +98,39 @@ class seq_gen():
             print("--------------------------------------------")
         return [B_0, B_1]
 
-    def get_sample_idx(self, Q, t_1, t_2):
+    def init_context(self, first_obs):
         """
-        INPUTS: Previous sequence array Q, index of previous time steps obs
-            - Always pass two time steps even if order is one
+        INPUTS: Observation(s) of the first `order` trials (scalar or array)
+        OUTPUT: Rolling context state - last two obs, last non-catch obs up
+        to t-1 and up to t-2 and row of the latest consecutive non-catch pair
+        """
+        return (first_obs, first_obs, first_obs, first_obs, 3*first_obs)
+
+    def get_sample_idx(self, context):
+        """
+        INPUTS: Rolling context state (scalars or arrays)
         OUTPUT: Markov-order dependent row sampling index for next obs
+            - Catch trials are skipped: order 1 uses the last non-catch obs,
+              order 2 the latest consecutive non-catch pair if the previous
+              trial was catch and the last non-catch obs before the trial
+              before if only that one was catch
         """
+        prev_obs, prev_prev_obs, last_nc, prev_nc, pair_idx = context
         if self.order == 1:
-            if Q[t_1, 1] == 0:
-                # E.g. prev obs was 0 - sample from row 0 next
-                idx = 0
-            elif Q[t_1, 1] == 1:
-                idx = 1
-            elif Q[t_1, 1] == 2:  # If prev one was catch recurse until not
-                counter = t_1
-                while Q[counter, 1] == 2:
-                    counter -= 1
-                idx = self.get_sample_idx(Q, counter, counter-1)
-            else:
-                raise ValueError("Wrong index - regime switches != obs!")
-
-        if self.order == 2:
-            if Q[t_1, 1] == 0 and Q[t_2, 1] == 0:
-                # E.g. prev obs was 0 and before was also 0 - sample row 0 next
-                idx = 0
-            elif Q[t_1, 1] == 0 and Q[t_2, 1] == 1:
-                idx = 1
-            elif Q[t_1, 1] == 1 and Q[t_2, 1] == 0:
-                idx = 2
-            elif Q[t_1, 1] == 1 and Q[t_2, 1] == 1:
-                idx = 3
-            else:
-                if Q[t_1, 1] == 2: # If prev one was catch recurse until not
-                    counter = t_1
-                    while Q[counter, 1] == 2 or Q[counter-1, 1] == 2:
-                        counter -= 1
-                    idx = self.get_sample_idx(Q, counter, counter-1)
-                elif Q[t_2, 1]==2: # If prev-prev one was catch recurse until not
-                    counter = t_2
-                    while Q[counter, 1] == 2:
-                        counter -= 1
-                    idx = self.get_sample_idx(Q, t_1, counter)
-        return idx
+            return last_nc
+        # Branch-free selection so that scalars and arrays share the code
+        idx = 2*prev_obs + prev_prev_obs
+        prev_catch = prev_obs == 2
+        prev_prev_catch = (prev_obs != 2) & (prev_prev_obs == 2)
+        return (idx + prev_catch*(pair_idx - idx) +
+                prev_prev_catch*(2*prev_obs + prev_nc - idx))
+
+    def update_context(self, context, obs):
+        # Constant time update of the rolling context with the new obs
+        prev_obs, prev_prev_obs, last_nc, prev_nc, pair_idx = context
+        no_catch = obs != 2
+        pair_idx = pair_idx + (no_catch & (prev_obs != 2))*(2*obs + prev_obs - pair_idx)
+        return (obs, prev_obs, last_nc + no_catch*(obs - last_nc), last_nc, pair_idx)
 
     def sample(self, seq_length):
         """
@@ -160,9 +151,10 @@ class seq_gen():
         act_regime = Q[self.order, 0]
 
         # Run sampling over the whole sequence
+        context = self.init_context(int(Q[0, 1]))
         for t in range(self.order, seq_length):
-            # Check if previous trial is catch
-            idx = self.get_sample_idx(Q, t-1, t-2)
+            # Row of the previous (non-catch) context
+            idx = self.get_sample_idx(context)
             Q[t, 1] = np.random.multinomial(1, self.transition_matrices[act_regime][idx, :]).argmax()
 
             # If regime switch is sampled - switch act_regime and try again
@@ -171,11 +163,11 @@ class seq_gen():
                     act_regime = 1
                 elif act_regime == 1:
                     act_regime = 0
-                idx = self.get_sample_idx(Q, t-1, t-2)
                 Q[t, 1] = np.random.multinomial(1, self.transition_matrices[act_regime][idx, :]).argmax()
 
             # Set active regime to the one which we finally sample
             Q[t, 0] = act_regime
+            context = self.update_context(context, int(Q[t, 1]))
 
         # Switch hidden state to 2 if catch trial is sampled
         Q[Q[:, 1] == 2, 0] = 2
@@ -190,6 +182,151 @@ class seq_gen():
             calc_stats(self.sample_seq, self.verbose)
         return self.sample_seq
 
+    def sample_batch(self, n_sequences, seq_length, rng=None):
+        """
+        INPUT:
+            * n_sequences: Number of independent sequences
+            * seq_length: Length of each observed sequence
+            * rng: Random generator (np.random.RandomState/Generator) - global
+              NumPy state if None
+        OUTPUT:
+            * samples: (n_sequences x t x 3) array: index, hidden, observed
+        DESCRIPTION:
+            Same generative process as sample, all sequences are advanced in
+            lockstep with inverse-CDF draws from the cumulative transition
+            matrices.
+        """
+        chunks = self.sample_chunks(n_sequences, seq_length, max(seq_length, 1), rng)
+        return np.concatenate(list(chunks) or [np.zeros((n_sequences, 0, 3))], axis=1)
+
+    def sample_chunks(self, n_sequences, seq_length, chunk_size, rng=None):
+        """
+        INPUT:
+            * n_sequences, seq_length, rng: As in sample_batch
+            * chunk_size: Number of trials per yielded chunk
+        OUTPUT:
+            * Generator of (n_sequences x chunk_size x 3) arrays (last chunk
+              may be shorter) - concatenated they equal sample_batch
+        DESCRIPTION:
+            Active regime and rolling context are carried over between chunks
+            so that memory stays bounded by the chunk size. A single sequence
+            is sampled by sample_chunks_single without per-trial array overhead.
+        """
+        rng = np.random if rng is None else rng
+        if n_sequences == 1:
+            yield from self.sample_chunks_single(seq_length, chunk_size, rng)
+            return
+        # Cumulative rows of both regimes stacked: row = regime*rows + context
+        n_rows = self.obs_space**self.order
+        cum_transitions = np.cumsum(np.vstack(self.transition_matrices), axis=1)[:, :3]
+
+        # Sample first states and observations uniformly
+        regime_init = rng.multinomial(self.order, self.prob_regime_init,
+                                      size=n_sequences).argmax(axis=1)
+        obs_init = rng.multinomial(self.order, self.prob_obs_init,
+                                   size=n_sequences).argmax(axis=1)
+        # Set the first active regime (Q[order, 0] as in sample)
+        act_regime = np.zeros(n_sequences, dtype=int)
+
+        # Rolling context of all sequences
+        context = self.init_context(obs_init.copy())
+
+        for start in range(0, seq_length, chunk_size):
+            stop = min(start + chunk_size, seq_length)
+            Q = np.zeros((n_sequences, stop - start, 2), dtype=int)
+
+            for t in range(start, stop):
+                if t < self.order:
+                    Q[:, t - start, 0] = regime_init
+                    Q[:, t - start, 1] = obs_init
+                    continue
+
+                idx = self.get_sample_idx(context)
+                row = act_regime*n_rows + idx
+                obs = (rng.uniform(size=(n_sequences, 1)) > cum_transitions[row]).sum(axis=1)
+                # If regime switch is sampled - switch act_regime and try again
+                switch = np.flatnonzero(obs == 3)
+                while len(switch):
+                    act_regime[switch] = 1 - act_regime[switch]
+                    row = act_regime[switch]*n_rows + idx[switch]
+                    obs[switch] = (rng.uniform(size=(len(switch), 1)) > cum_transitions[row]).sum(axis=1)
+                    switch = switch[obs[switch] == 3]
+
+                # Set active regime to the one which we finally sample
+                Q[:, t - start, 0] = act_regime
+                Q[:, t - start, 1] = obs
+
+                # Advance rolling context
+                context = self.update_context(context, obs)
+
+            # Switch hidden state to 2 if catch trial is sampled
+            Q[Q[:, :, 1] == 2, 0] = 2
+            # Change catch trial to 0.5 instead of 2 for nice plotting
+            Q = Q.astype(float)
+            Q[Q[:, :, 1] == 2, 1] = 0.5
+
+            # Add column with trial/obs/time
+            time = np.broadcast_to(np.arange(start, stop, dtype=float),
+                                   (n_sequences, stop - start))
+            yield np.concatenate((time[:, :, np.newaxis], Q), axis=2)
+
+
+    def sample_chunks_single(self, seq_length, chunk_size, rng):
+        """
+        Scalar counterpart of sample_chunks for a single sequence
+            * Uniforms are drawn a chunk at a time and consumed in the order
+              of the batch path (one per trial, one per regime switch redraw),
+              so the output equals sample_chunks with n_sequences=1
+        """
+        n_rows = self.obs_space**self.order
+        cum_transitions = np.cumsum(np.vstack(self.transition_matrices), axis=1)[:, :3].tolist()
+
+        # Sample first states and observations uniformly
+        regime_init = int(rng.multinomial(self.order, self.prob_regime_init, size=1).argmax())
+        obs_init = int(rng.multinomial(self.order, self.prob_obs_init, size=1).argmax())
+        act_regime = 0
+        context = self.init_context(obs_init)
+
+        uniforms, pos = [], 0
+        for start in range(0, seq_length, chunk_size):
+            stop = min(start + chunk_size, seq_length)
+            Q = np.zeros((stop - start, 2), dtype=int)
+            hidden, observed = [], []
+
+            for t in range(start, stop):
+                if t < self.order:
+                    hidden.append(regime_init)
+                    observed.append(obs_init)
+                    continue
+
+                idx = self.get_sample_idx(context)
+                while True:
+                    if pos == len(uniforms):
+                        uniforms, pos = rng.uniform(size=chunk_size).tolist(), 0
+                    u = uniforms[pos]
+                    pos += 1
+                    cum = cum_transitions[act_regime*n_rows + idx]
+                    obs = (u > cum[0]) + (u > cum[1]) + (u > cum[2])
+                    # If regime switch is sampled - switch act_regime and try again
+                    if obs != 3:
+                        break
+                    act_regime = 1 - act_regime
+
+                hidden.append(act_regime)
+                observed.append(obs)
+                context = self.update_context(context, obs)
+
+            Q[:, 0] = hidden
+            Q[:, 1] = observed
+            # Switch hidden state to 2 if catch trial is sampled
+            Q[Q[:, 1] == 2, 0] = 2
+            # Change catch trial to 0.5 instead of 2 for nice plotting
+            Q = Q.astype(float)
+            Q[Q[:, 1] == 2, 1] = 0.5
+
+            # Add column with trial/obs/time
+            yield np.column_stack((np.arange(start, stop), Q))[np.newaxis]
+
 
 def save(sequence, seq_gen_temp, matlab_out):
 
@@ -208,6 +345,25 @@ def save(sequence, seq_gen_temp, matlab_out):
     print('Saved data and outfiled file')
 
 
+def stream_and_save(seq_gen_temp, seq_length, chunk_size, title, rng=None):
+    """
+    Sample a (very long) sequence chunk by chunk and append every chunk to a
+    resizable HDF5 dataset - memory is bounded by the chunk size
+    """
+    def catch_as_two(chunks):
+        # Catch trials are stored as 2 as in save
+        for chunk in chunks:
+            chunk[chunk[:, :, 2] == 0.5, 2] = 2
+            yield chunk
+
+    attrs = {key: getattr(seq_gen_temp, key) for key in
+             ["prob_regime_init", "prob_obs_init", "prob_obs_change",
+              "prob_regime_change", "prob_catch", "order"]}
+    chunks = seq_gen_temp.sample_chunks(1, seq_length, chunk_size, rng)
+    save_chunks(catch_as_two(chunks), results_dir + title,
+                min(chunk_size, seq_length), attrs)
+
+
 def sample_and_save(seq_gen_temp, seq_length, title, matlab_out, plot_seq):
     sequence = seq_gen_temp.sample(seq_length)
     stats, reg_0s, reg_1s = calc_stats(sequence, False)
@@ -328,6 +484,9 @@ if __name__ == "__main__":
                         action="store_true",
                         default=False,
                         help='View/Plot the sampled sequence')
+    parser.add_argument('-chunk', '--chunk_size', action="store",
+                        default=0, type=int,
+                        help='Stream sequence to HDF5 in chunks of this size')
     parser.add_argument('-v', '--verbose',
                         action="store_true",
                         default=False,
@@ -352,7 +511,10 @@ if __name__ == "__main__":
                        prob_obs_init, prob_obs_change, verbose)
 
     # sequence = gen_temp.sample(seq_length)
-    sample_and_save(gen_temp, seq_length, title, matlab_out, plot_seq)
+    if args.chunk_size > 0:
+        stream_and_save(gen_temp, seq_length, args.chunk_size, title)
+    else:
+        sample_and_save(gen_temp, seq_length, title, matlab_out, plot_seq)
     """
     pythonw seq_gen.py -t 2nd_5_01_5_10_200 -obs_change 0.45 0.45 0.05 0.05 0.05 0.05 0.45 0.45 -order 2 -matlab
     """
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def emission_likelihoods(obs, emissionprob):
+    """
+    Likelihood of each observed symbol under every hidden state
+        * obs: (n_sequences x T) symbol codes, padding has negative codes
+        * emissionprob: shared (K x M) or per-sequence (n_sequences x K x M)
+    Output: (n_sequences x T x K) array - padded trials have likelihood 1
+    """
+    codes = np.maximum(obs, 0)
+    if emissionprob.ndim == 2:
+        likelihood = emissionprob.T[codes]
+    else:
+        likelihood = np.take_along_axis(emissionprob[:, np.newaxis],
+                                        codes[:, :, np.newaxis, np.newaxis],
+                                        axis=3)[..., 0]
+    likelihood[obs < 0] = 1.
+    return likelihood
+
+
+def forward_backward(obs, startprob, transmat, emissionprob):
+    """
+    Scaled forward/backward recursions for a batch of discrete HMM sequences
+        * obs: single sequence (T) or batch (n_sequences x T) of symbol codes
+          padded at the end with negative values
+        * Parameters are shared by all sequences - startprob (K), transmat
+          (K x K), emissionprob (K x M) - or given per sequence with a leading
+          n_sequences axis
+        * Forward messages are normalized at every trial, the log of the
+          normalizers sums to the log-likelihood so long blocks don't underflow
+    Output: Log-likelihood per sequence, filtered p(s_t | x_1:t) and smoothed
+    p(s_t | x_1:T) state posteriors (n_sequences x T x K) - padded trials keep
+    the posterior of the last observed trial
+    """
+    obs = np.atleast_2d(obs).astype(int)
+    mask = obs >= 0
+    ragged = not mask.all()
+    n_sequences, T = obs.shape
+    likelihood = emission_likelihoods(obs, emissionprob)
+    # Per-sequence transition matrices act on row vectors via batched matmul
+    if transmat.ndim == 2:
+        propagate = lambda alpha: np.matmul(alpha, transmat)
+        propagate_back = lambda beta: np.matmul(beta, transmat.T)
+    else:
+        propagate = lambda alpha: np.matmul(alpha[:, np.newaxis], transmat)[:, 0]
+        propagate_back = lambda beta: np.matmul(transmat, beta[:, :, np.newaxis])[..., 0]
+
+    filtered = np.zeros(likelihood.shape)
+    scales = np.ones((n_sequences, T))
+
+    # Forward pass: alpha_t = (alpha_{t-1} A) * B_t / c_t
+    alpha = startprob*likelihood[:, 0]
+    for t in range(T):
+        if t > 0:
+            alpha = propagate(filtered[:, t-1])*likelihood[:, t]
+            # Padded trials carry the last filtered posterior forward
+            if ragged:
+                alpha[~mask[:, t]] = filtered[~mask[:, t], t-1]
+        scales[:, t] = alpha.sum(axis=1)
+        filtered[:, t] = alpha/scales[:, t, np.newaxis]
+    scales[~mask] = 1.
+
+    # Backward pass: beta_t = A (B_{t+1} * beta_{t+1}) / c_{t+1}
+    smoothed = np.zeros(likelihood.shape)
+    beta = np.ones((n_sequences, likelihood.shape[2]))
+    smoothed[:, T-1] = filtered[:, T-1]
+    for t in range(T-2, -1, -1):
+        beta_next = propagate_back(likelihood[:, t+1]*beta)/scales[:, t+1, np.newaxis]
+        if ragged:
+            beta_next[~mask[:, t+1]] = beta[~mask[:, t+1]]
+        beta = beta_next
+        posterior = filtered[:, t]*beta
+        smoothed[:, t] = posterior/posterior.sum(axis=1, keepdims=True)
+
+    return np.log(scales).sum(axis=1), filtered, smoothed
+
+
+def predictive_distribution(filtered, transmat, emissionprob):
+    """
+    One-step posterior predictive of the next symbol for every trial
+    Output: (n_sequences x T x M) array p(x_t+1 | x_1:t)
+    """
+    transmat = np.broadcast_to(transmat, (filtered.shape[0],) + transmat.shape[-2:])
+    emissionprob = np.broadcast_to(emissionprob, (filtered.shape[0],) + emissionprob.shape[-2:])
+    prior_states = np.einsum("nti,nij->ntj", filtered, transmat)
+    return np.einsum("ntj,njm->ntm", prior_states, emissionprob)
@@ -1,8 +1,15 @@
 import os
 import argparse
 import numpy as np
+from scipy.signal import lfilter
+from scipy.special import gammaln, digamma
 from utils.helpers import *
 
+# TP tables with more contexts (no_obs**order) are stored as sparse dicts
+MAX_DENSE_CONTEXTS = 4096
+# Memoized special functions only pay off for tables with more alphas
+MIN_CACHED_SIZE = 1024
+
 
 class SBL_Cat_Dir():
     """
@@ -11,68 +18,160 @@ class SBL_Cat_Dir():
         * She updates her conjugate Cat-Dirichlet posterior with new evidence
         * She calculates different surprise measures as the events come in
     INPUT:  Sequence, type: estimated statistics (SP, AP, TP), order: order of TP inference,
-    tau: exponentially weighted forgetting parameter
+    tau: exponentially weighted forgetting parameter, incremental: recursively
+    carry decayed counts forward (O(1) per trial) instead of recomputing them,
+    max_dense_contexts: TP tables with more contexts are stored as sparse dict,
+    no_obs: alphabet size - required for streaming (seq=None) via step(obs)
     OUTPUT: Predictive surprisal, Bayesian surprisal, Confidence-corrected surprisal
-    [t, o_t, s_t, Prediction_Surprise, Bayesian_Surprise, Confidence_Corrected_Surprise]
+    Structured array with columns [time, sequence, hidden, predictive_surprise,
+    bayesian_surprise, confidence_corrected_surprise, alphas]
     """
-    def __init__(self, seq, hidden, tau, model_type, order, verbose=False):
+    def __init__(self, seq, hidden, tau, model_type, order, verbose=False,
+                 incremental=True, max_dense_contexts=MAX_DENSE_CONTEXTS,
+                 no_obs=None):
         # Initialize SBL-learned sequence and exponential forgetting parameter
-        self.sequence = seq.astype(int)
         self.hidden = hidden
-        self.T = len(seq)
         self.order = order
         self.type = model_type
         self.tau = tau
         self.verbose = verbose
-        self.no_obs = np.unique(seq).shape[0]
-        self.stim_ind = np.zeros((self.T, self.no_obs))
-
-        # Construct matrix where col represents binary ind of specific stim at t
-        for t in range(self.T):
-            self.stim_ind[t, self.sequence[t]] = 1
-
-        # AP: Generate T-dim vector indicating no-alternation from t-1 to t
-        self.repetition = np.zeros(self.T)
-        for t in range(1, self.T):
-            if self.sequence[t] == self.sequence[t-1]:
-                self.repetition[t] = 1
-
-        # TP: Generate T-dim vectors indicating transition from state i
-        if self.order == 1:
-            self.transitions = np.zeros((self.T, self.no_obs))
-            for t in range(1, self.T):
-                self.transitions[t, 0] = (self.sequence[t-1] == 0)
-                self.transitions[t, 1] = (self.sequence[t-1] == 1)
-                self.transitions[t, 2] = (self.sequence[t-1] == 2)
-        # TP: For second order also include transitions from t-2
-        elif self.order == 2:
-            self.transitions = np.zeros((self.T, self.no_obs, self.order))
-            for t in range(2, self.T):
-                self.transitions[t, 0, 0] = (self.sequence[t-1] == 0)
-                self.transitions[t, 1, 0] = (self.sequence[t-1] == 1)
-                self.transitions[t, 2, 0] = (self.sequence[t-1] == 2)
-                self.transitions[t, 0, 1] = (self.sequence[t-2] == 0)
-                self.transitions[t, 1, 1] = (self.sequence[t-2] == 1)
-                self.transitions[t, 2, 1] = (self.sequence[t-2] == 2)
+        self.incremental = incremental
+
+        if seq is None:
+            # Streaming agent: only sufficient statistics are kept in memory
+            if no_obs is None:
+                raise ValueError("Provide alphabet size for streaming agent")
+            self.T = 0
+            self.no_obs = no_obs
+            self.incremental = True
         else:
-            raise "Provide supported order (1st or 2nd)"
+            self.sequence = seq.astype(int)
+            self.T = len(seq)
+            self.no_obs = np.unique(seq).shape[0] if no_obs is None else no_obs
+            self.stim_ind = np.zeros((self.T, self.no_obs))
+
+            # Construct matrix where col represents binary ind of specific stim at t
+            for t in range(self.T):
+                self.stim_ind[t, self.sequence[t]] = 1
+
+            # AP: Generate T-dim vector indicating no-alternation from t-1 to t
+            self.repetition = np.zeros(self.T)
+            for t in range(1, self.T):
+                if self.sequence[t] == self.sequence[t-1]:
+                    self.repetition[t] = 1
+
+            # TP: Base-K index of the previous `order` stimuli (-1 if not enough)
+            self.context = encode_context(self.sequence, self.order, self.no_obs)
+
+            # Generate one T matrix with all discounting values
+            self.exp_forgetting = np.exp(-self.tau*np.arange(self.T)[::-1])
 
-        # Generate one T matrix with all discounting values
-        self.exp_forgetting = np.exp(-self.tau*np.arange(self.T)[::-1])
+        self.no_contexts = self.no_obs**self.order
+        # Rolling state: trial counter, last obs and base-K context window
+        self.t = 0
+        self.last_obs = -1
+        self.last_context = 0
+
+        # Large TP tables only store the alphas that differ from 1
+        self.sparse = (self.type == "TP" and
+                       self.no_contexts > max_dense_contexts)
+        # Sparse table: alphas[slots[flat transition index]]
+        self.slots = {}
 
         if self.type == "SP":
             self.alphas = np.ones(self.no_obs)
         elif self.type == "AP":
             self.alphas = np.ones(2)
         elif self.type == "TP":
-            if self.order == 1:
-                self.alphas = np.ones((self.no_obs, self.no_obs))
-            elif self.order == 2:
-                self.alphas = np.ones((self.no_obs, self.no_obs, self.no_obs))
+            if self.sparse:
+                # Slot storage grows geometrically, alphas views the used slots
+                self.alpha_buffer = np.ones(16)
+                self.alphas = self.alpha_buffer[:0]
+                self.incremental = True
+                # Running totals of the stored alphas for tau = 0: evidence
+                # sum(alpha - 1), sum(lnGamma(alpha)), sum((alpha - 1)*psi(alpha))
+                self.evidence = 0
+                self.sum_lgamma = 0.
+                self.sum_psi = 0.
+            else:
+                # from-context to-stimulus alphas
+                self.alphas = np.ones((self.no_contexts, self.no_obs))
+        else:
+            raise "Provide right model type (SP, AP, TP)"
+
+        # Number of Dirichlet parameters (also of sparse TP tables)
+        if self.type == "TP":
+            self.table_size = self.no_contexts*self.no_obs
+        else:
+            self.table_size = self.alphas.size
+
+        # Without forgetting all alphas are integers: serve gammaln/digamma
+        # of large tables from memoized tables up to the sequence length
+        self.cached = self.tau == 0 and self.table_size >= MIN_CACHED_SIZE
+        if self.cached:
+            extend_special_tables(self.T + self.table_size + 1)
+
+        # Decayed evidence counts for recursive updating (alphas = 1 + counts)
+        self.decay = np.exp(-self.tau)
+        self.alpha_naive_init = self.alphas.copy()
+        if not self.sparse:
+            self.counts = np.zeros(self.alphas.shape)
+
+    def observed_index(self, obs):
+        # Index of the alpha corresponding to obs given the rolling state
+        if self.type == "SP":
+            return obs
+        elif self.type == "AP":
+            return int(obs == self.last_obs)
+        elif self.type == "TP":
+            # from and to stimulus transition (context 0 before `order` obs)
+            context = self.last_context if self.t >= self.order else 0
+            if self.sparse:
+                return context*self.no_obs + obs
+            return (context, obs)
         else:
             raise "Provide right model type (SP, AP, TP)"
 
+    def update_posterior_incremental(self):
+        # Geometric forgetting: alpha_t = 1 + e^{-tau}*(alpha_{t-1} - 1) + ind_t
+        # TP: No transition observed before `order` obs
+        add_evidence = self.type != "TP" or self.t >= self.order
+
+        if self.sparse:
+            # Decay in place (no forgetting: nothing to decay)
+            if self.tau != 0:
+                self.alphas -= 1
+                self.alphas *= self.decay
+                self.alphas += 1
+            if add_evidence:
+                slot = self.slots.get(self.ind)
+                if slot is None:
+                    slot = self.add_slot(self.ind)
+                self.alphas[slot] += 1
+            return
+
+        self.counts *= self.decay
+        if add_evidence:
+            self.counts[self.ind] += 1
+
+        self.alphas = 1 + self.counts
+        # Same convention as full update - no repetition possible if only 1 obs!
+        if self.type == "AP" and self.t == 0:
+            self.alphas = np.ones(2)
+
+    def add_slot(self, key):
+        # New sparse transition - doubling the storage keeps appends amortized O(1)
+        n_slots = len(self.alphas)
+        if n_slots == len(self.alpha_buffer):
+            self.alpha_buffer = np.append(self.alpha_buffer, np.ones(n_slots))
+        self.slots[key] = n_slots
+        self.alphas = self.alpha_buffer[:n_slots + 1]
+        return n_slots
+
     def update_posterior(self):
+        if self.incremental:
+            return self.update_posterior_incremental()
+
         exp_weighting = self.exp_forgetting[-(self.t+1):]
 
         if self.type == "SP":
@@ -93,23 +192,21 @@ class SBL_Cat_Dir():
 
         elif self.type == "TP":
             if self.t < self.order:
-                if self.order == 1:
-                    self.alphas = np.ones((self.no_obs, self.no_obs))
-                elif self.order == 2:
-                    self.alphas = np.ones((self.no_obs, self.no_obs, self.no_obs))
+                self.alphas = np.ones((self.no_contexts, self.no_obs))
             else:
-                for i in range(self.no_obs):
-                    for j in range(self.no_obs):
-                        # First order
-                        if self.order == 1:
-                             # from-to alphas
-                             self.alphas[i, j] = 1 + np.dot(exp_weighting, self.stim_ind[:self.t+1, j]*self.transitions[:self.t+1, i])
-                        # Second orderSBL_Cat_Dir
-                        elif self.order == 2:
-                            for k in range(self.no_obs):
-                                self.alphas[k, i, j] = 1 + np.dot(exp_weighting, self.stim_ind[:self.t+1, j]*self.transitions[:self.t+1, i, 0]*self.transitions[:self.t+1, k, 1])
+                # Weighted count of all from-context to-stimulus transitions
+                transitions = (self.context[self.order:self.t+1]*self.no_obs +
+                               self.sequence[self.order:self.t+1])
+                self.alphas = 1 + np.bincount(transitions,
+                                              weights=exp_weighting[self.order:],
+                                              minlength=self.alphas.size).reshape(self.alphas.shape)
 
     def posterior_predictive(self, alphas):
+        if self.type == "TP":
+            # Normalize along the oldest stimulus of the context, i.e. the
+            # first axis of the (no_obs x ... x no_obs) transition tensor
+            alphas_full = alphas.reshape((self.no_obs, -1, self.no_obs))
+            return (alphas_full/alphas_full.sum(axis=0)).reshape(alphas.shape)
         return np.array([alpha/alphas.sum(axis=0) for alpha in alphas])
 
     def naive_posterior(self, ind):
@@ -119,70 +216,415 @@ class SBL_Cat_Dir():
         return naive_update
 
     def predictive_surprisal(self, alphas, ind):
-        return -np.log(self.posterior_predictive(alphas)[ind])
+        if self.sparse:
+            # Same normalization as posterior_predictive on the dense table
+            rest = ind % self.no_contexts
+            alphas_ind = [alphas[self.slots[key]]
+                          if self.slots.get(key, len(alphas)) < len(alphas) else 1.
+                          for key in rest + self.no_contexts*np.arange(self.no_obs)]
+            return -np.log(alphas_ind[ind // self.no_contexts]/sum(alphas_ind))
+        elif self.type == "TP":
+            # Only the normalizer of the observed transition is needed
+            context, obs = ind
+            norm = alphas.reshape((self.no_obs, -1, self.no_obs))[:, context % (self.no_contexts // self.no_obs), obs].sum()
+            return -np.log(alphas[ind]/norm)
+        return -np.log(alphas[ind]/alphas.sum())
 
     def bayesian_surprisal(self, alphas_old, alphas):
-        return kl_dir(alphas_old, alphas)
+        if self.sparse:
+            # Alphas of transitions first seen at this trial were 1 before
+            alphas_old = np.append(alphas_old, np.ones(len(alphas) - len(alphas_old)))
+            return kl_dir_sparse(alphas_old, alphas, self.table_size,
+                                 cached=self.cached)
+        return kl_dir(alphas_old, alphas, cached=self.cached)
 
     def corrected_surprisal(self, alphas_old, ind):
-        return kl_dir(alphas_old, self.naive_posterior(ind))
+        if self.sparse:
+            # Slot after the stored alphas holds the observation if unseen
+            alphas_old = np.append(alphas_old, 1.)
+            naive_update = np.ones(len(alphas_old))
+            naive_update[self.slots.get(ind, len(alphas_old) - 1)] += 1
+            return kl_dir_sparse(alphas_old, naive_update, self.table_size,
+                                 cached=self.cached)
+        return kl_dir(alphas_old, self.naive_posterior(ind), cached=self.cached)
+
+    def update(self, observation):
+        """
+        Update the posterior with a single observation and advance the
+        rolling state
+        Output: Alphas before the update and index of the observed alpha
+        """
+        obs = int(observation)
+        self.ind = self.observed_index(obs)
+
+        alphas_old = self.alphas.copy()
+        self.update_posterior()
+        self.advance(obs)
+        return alphas_old, self.ind
+
+    def advance(self, obs):
+        # Advance rolling state - context keeps the last `order` observations
+        self.last_obs = obs
+        self.last_context = (self.last_context*self.no_obs + obs) % self.no_contexts
+        self.t += 1
+
+    def step_sparse_counts(self, observation):
+        """
+        Sparse TP step without forgetting - O(1) in the number of stored alphas
+            * The observation only increments its own alpha, so BS and CS
+              follow from that alpha and the running totals of the table
+        Output: Predictive, Bayesian and Confidence-corrected surprisal
+        """
+        obs = int(observation)
+        self.ind = self.observed_index(obs)
+        PS = self.predictive_surprisal(self.alphas, self.ind)
+
+        slot = self.slots.get(self.ind)
+        alpha_ind = 1. if slot is None else self.alphas[slot]
+        alpha_0 = self.table_size + self.evidence
+        psi_0 = digamma(alpha_0)
+        psi_ind = digamma(alpha_ind)
+
+        # Naive posterior (flat prior + 1 obs) has all lnGamma terms equal to 0
+        CS = (gammaln(alpha_0) - self.sum_lgamma - gammaln(self.table_size + 1) +
+              self.sum_psi - self.evidence*psi_0 - (psi_ind - psi_0))
+
+        if self.t >= self.order:
+            # KL(alpha || alpha + e_ind): lnGamma/psi recursions of one entry
+            BS = np.log(alpha_ind) - np.log(alpha_0) + psi_0 - psi_ind
+            self.sum_lgamma += np.log(alpha_ind)
+            self.sum_psi += psi_ind + 1
+            self.evidence += 1
+        else:
+            BS = 0.
+
+        self.update_posterior()
+        self.advance(obs)
+        return PS, BS, CS
+
+    def step(self, observation):
+        """
+        Streaming interface: update the posterior with a single observation
+        Output: Predictive, Bayesian and Confidence-corrected surprisal
+        """
+        if self.sparse and self.tau == 0:
+            return self.step_sparse_counts(observation)
+        alphas_old, ind = self.update(observation)
+
+        PS = self.predictive_surprisal(alphas_old, ind)
+        BS = self.bayesian_surprisal(alphas_old, self.alphas)
+        CS = self.corrected_surprisal(alphas_old, ind)
+        return PS, BS, CS
+
+    def results_dtype(self):
+        # Named columns of the preallocated results buffer
+        columns = [("time", int), ("sequence", int), ("hidden", float),
+                   ("predictive_surprise", float), ("bayesian_surprise", float),
+                   ("confidence_corrected_surprise", float)]
+        # Sparse TP tables are too large to be stored for every trial
+        if not self.sparse:
+            columns.append(("alphas", float, self.alphas.shape))
+        return np.dtype(columns)
 
     def compute_surprisal(self, max_T, verbose_surprisal=False):
         if verbose_surprisal:
             print("{}: Computing different surprisal measures for {} timesteps.".format(self.type, max_T))
-        results = []
+        results = np.zeros(max_T, dtype=self.results_dtype())
+        results["time"] = np.arange(max_T)
+        results["sequence"] = self.sequence[:max_T]
+        results["hidden"] = self.hidden[:max_T]
+
+        if self.sparse:
+            for t in range(max_T):
+                # Loop over the full sequence and compute surprisal iteratively
+                surprisal = self.step(self.sequence[t])
+                (results["predictive_surprise"][t], results["bayesian_surprise"][t],
+                 results["confidence_corrected_surprise"][t]) = surprisal
+        else:
+            # Store the alphas of all trials and compute BS/CS in one call -
+            # the alphas before each update are those stored at the trial before
+            alphas_init = self.alphas.copy()
+            ind_flat = np.zeros(max_T, dtype=int)
+            for t in range(max_T):
+                alphas_old, ind = self.update(self.sequence[t])
+                results["predictive_surprise"][t] = self.predictive_surprisal(alphas_old, ind)
+                results["alphas"][t] = self.alphas
+                ind_flat[t] = np.ravel_multi_index(np.atleast_1d(ind), self.alphas.shape)
+
+            event_ndim = self.alphas.ndim
+            alphas = results["alphas"]
+            if max_T > 0:
+                results["bayesian_surprise"][0] = kl_dir(alphas_init, alphas[0], cached=self.cached)
+                results["confidence_corrected_surprise"][0] = kl_dir_naive_batch(
+                    alphas_init, ind_flat[0], event_ndim, cached=self.cached)
+            if max_T > 1:
+                results["bayesian_surprise"][1:] = kl_dir_batch(alphas[:-1], alphas[1:],
+                                                                event_ndim, cached=self.cached)
+                results["confidence_corrected_surprise"][1:] = kl_dir_naive_batch(
+                    alphas[:-1], ind_flat[1:], event_ndim, cached=self.cached)
 
-        self.alpha_naive_init = self.alphas.copy()
-        for t in range(max_T):
-            # Loop over the full sequence and compute surprisal iteratively
-            alphas_old = self.alphas.copy()
-            self.t = t
-            self.update_posterior()
-
-            if self.type == "SP":
-                ind = int(self.sequence[self.t])
-            elif self.type == "AP":
-                ind = int(self.repetition[self.t])
-            elif self.type == "TP":
-                # from and to stimulus transition
-                if self.order == 1:
-                    ind = (np.argmax(self.transitions[self.t, :]), np.argmax(self.stim_ind[self.t, :]))
-                elif self.order == 2:
-                    ind = (np.argmax(self.transitions[self.t, :, 1]), np.argmax(self.transitions[self.t, :, 0]), np.argmax(self.stim_ind[self.t, :]))
-            else:
-                raise "Provide right model type (SP, AP, TP)"
+        if verbose_surprisal:
+            for t in range(max_T):
+                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1,
+                      round(results["predictive_surprise"][t], 4),
+                      round(results["bayesian_surprise"][t], 4),
+                      round(results["confidence_corrected_surprise"][t], 4)))
 
-            PS_temp = self.predictive_surprisal(alphas_old, ind)
-            BS_temp = self.bayesian_surprisal(alphas_old, self.alphas)
-            CS_temp = self.corrected_surprisal(alphas_old, ind)
+        print("{}: Done computing surprisal measures for all {} timesteps.".format(self.type, self.T))
+        return results
 
-            if verbose_surprisal:
-                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1, round(PS_temp, 4),  round(BS_temp, 4), round(CS_temp, 4)))
 
-            temp = [t, self.sequence[t], self.hidden[t], PS_temp, BS_temp, CS_temp]
-            distr_params = list(self.alphas.reshape(1, -1)[0])
-            results.append(temp + distr_params)
+def pad_sequences(seqs):
+    """
+    Stack ragged sequences into an (n_sequences x T_max) array
+    Output: padded sequences (padding value -1) and mask of observed trials
+    """
+    lengths = [len(seq) for seq in seqs]
+    padded = -np.ones((len(seqs), max(lengths)), dtype=int)
+    for i, seq in enumerate(seqs):
+        padded[i, :lengths[i]] = seq
+    return padded, padded >= 0
 
-        print("{}: Done computing surprisal measures for all {} timesteps.".format(self.type, self.T))
-        return np.asarray(results)
+
+def encode_observations(seq, model_type, order, no_obs):
+    """
+    Vectorized counterpart of the SBL_Cat_Dir indicator construction
+        * seq can be a single sequence (T) or a batch (n_sequences x T) padded
+          at the end with negative values
+    Output: flat index of the Dirichlet parameter observed at each trial,
+    boolean array indicating trials that add evidence (TP needs `order`
+    predecessors, padding adds none) and the shape of the alpha array
+    """
+    seq = seq.astype(int)
+    mask = seq >= 0
+    valid = mask.copy()
+
+    if model_type == "SP":
+        ind = seq.copy()
+        shape = (no_obs,)
+    elif model_type == "AP":
+        ind = np.zeros(seq.shape, dtype=int)
+        ind[..., 1:] = (seq[..., 1:] == seq[..., :-1])
+        shape = (2,)
+    elif model_type == "TP":
+        # Trials without full history are indexed as transitions from context 0
+        context = encode_context(seq, order, no_obs)
+        ind = np.maximum(context, 0)*no_obs + seq
+        valid &= context >= 0
+        shape = (no_obs,)*(order + 1)
+    else:
+        raise ValueError("Provide right model type (SP, AP, TP)")
+    ind[~mask] = 0
+    return ind, valid, shape
 
 
-def main(seq, hidden, tau, model_type, order,
-         save_results=False, title="temp", verbose=False):
-    # Compute Surprisal for all time steps for DirCat Model
-    CD_SBL_temp = SBL_Cat_Dir(seq, hidden, tau, model_type, order, verbose)
-    results = CD_SBL_temp.compute_surprisal(max_T=CD_SBL_temp.T, verbose_surprisal=verbose)
+def evidence_from_observations(ind, valid, D):
+    """
+    One-hot (T x D) matrix of the evidence each trial adds to the alphas
+    """
+    return ((ind[..., np.newaxis] == np.arange(D)) &
+            valid[..., np.newaxis]).astype(float)
+
+
+def decayed_alphas(evidence, tau, model_type):
+    """
+    Exponentially forgotten sums of the evidence for all trials at once:
+    alpha_t = 1 + e^{-tau}*(alpha_{t-1} - 1) + evidence_t as an IIR filter
+    """
+    alphas = 1 + lfilter([1.], [1., -np.exp(-tau)], evidence, axis=-2)
+    # No repetition possible if only 1 obs!
+    if model_type == "AP":
+        alphas[..., 0, :] = 1
+    return alphas
+
+
+def surprisal_from_alphas(alphas, ind, shape, cached=False):
+    """
+    PS, BS and CS for a (T x D) series of alphas and the observed indices
+        * Flat prior is prepended so that the alphas before each update are
+          a shifted view of the series
+        * gammaln/digamma are evaluated once on the series and shared by BS/CS
+        * cached: integer alphas (no forgetting) are served from memoized tables
+    """
+    lgamma, psi = (gammaln_cached, digamma_cached) if cached else (gammaln, digamma)
+    D = alphas.shape[-1]
+    flat = np.ones(alphas.shape[:-2] + (1, D))
+    series = np.concatenate((flat, alphas), axis=-2)
 
-    time = results[:, 0]
-    sequence = results[:, 1]
-    hidden = results[:, 2]
-    PS = results[:, 3]
-    BS = results[:, 4]
-    CS = results[:, 5]
+    alpha_0 = series.sum(axis=-1)
+    lg_part = lgamma(alpha_0) - lgamma(series).sum(axis=-1)
+    psi_part = psi(series) - psi(alpha_0)[..., np.newaxis]
+
+    alphas_old = series[..., :-1, :]
+    psi_old = psi_part[..., :-1, :]
+    ind = ind[..., np.newaxis]
+
+    # Posterior predictive normalizes along the first axis of the alpha array
+    norm = alphas_old.reshape(alphas_old.shape[:-1] + shape)
+    norm = norm.sum(axis=alphas_old.ndim - 1).reshape(alphas_old.shape[:-1] + (-1,))
+    PS = -np.log(np.take_along_axis(alphas_old, ind, axis=-1) /
+                 np.take_along_axis(norm, ind % norm.shape[-1], axis=-1))[..., 0]
+
+    BS = (lg_part[..., :-1] - lg_part[..., 1:] +
+          ((alphas_old - alphas)*psi_old).sum(axis=-1))
+
+    # Naive posterior (flat prior + 1 obs) has all lnGamma terms equal to 0
+    CS = (lg_part[..., :-1] - gammaln(D + 1) +
+          ((alphas_old - 1)*psi_old).sum(axis=-1) -
+          np.take_along_axis(psi_old, ind, axis=-1)[..., 0])
+    return PS, BS, CS
+
+
+def compute_surprisal_vectorized(seq, tau, model_type, order, no_obs=None):
+    """
+    Whole-sequence surprisal for the Cat-Dir agent without a loop over trials
+        * Decayed counts of all trials are obtained with a single IIR filter
+        * PS, BS and CS are evaluated on the (T x D) arrays of alphas
+        * A padded (n_sequences x T) batch is processed in the same calls
+    Output: PS, BS, CS (T-dim vectors, NaN at padding) and alphas (T x D)
+    after each update
+    """
+    if no_obs is None:
+        no_obs = np.unique(seq[seq >= 0]).shape[0]
+    ind, valid, shape = encode_observations(seq, model_type, order, no_obs)
+    evidence = evidence_from_observations(ind, valid, int(np.prod(shape)))
+
+    alphas = decayed_alphas(evidence, tau, model_type)
+    PS, BS, CS = surprisal_from_alphas(alphas, ind, shape, cached=(tau == 0))
+    for surprise in (PS, BS, CS):
+        surprise[seq < 0] = np.nan
+    return PS, BS, CS, alphas
+
+
+def compute_surprisal_tau_grid(seq, taus, model_type, order, no_obs=None):
+    """
+    Surprisal regressors for a grid of forgetting parameters
+        * Sequence encoding and evidence matrix are shared by all taus
+        * Each tau only costs one IIR filter and the vectorized surprisal
+    Output: PS, BS, CS as (n_tau x T) arrays
+    """
+    if no_obs is None:
+        no_obs = np.unique(seq).shape[0]
+    ind, valid, shape = encode_observations(seq, model_type, order, no_obs)
+    evidence = evidence_from_observations(ind, valid, int(np.prod(shape)))
+
+    PS, BS, CS = [np.zeros((len(taus), len(ind))) for i in range(3)]
+    for i, tau in enumerate(taus):
+        alphas = decayed_alphas(evidence, tau, model_type)
+        PS[i], BS[i], CS[i] = surprisal_from_alphas(alphas, ind, shape,
+                                                    cached=(tau == 0))
+    return PS, BS, CS
+
+
+def main_vectorized(seq, hidden, tau, model_type, order,
+                    save_results=False, title="temp", verbose=False):
+    # Compute Surprisal for all time steps at once for DirCat Model
+    PS, BS, CS, alphas = compute_surprisal_vectorized(seq, tau, model_type, order)
+    if verbose:
+        print("{}: Done computing surprisal measures for all {} timesteps.".format(model_type, len(seq)))
+
+    if save_results:
+        results_formatted = {"time": np.arange(len(seq)),
+                             "sequence": seq,
+                             "hidden": hidden,
+                             "predictive_surprise": PS,
+                             "bayesian_surprise": BS,
+                             "confidence_corrected_surprise": CS}
+
+        save_obj(results_formatted, results_dir + title)
+        print("Saved in File: {}".format(results_dir + title))
+    else:
+        return PS, BS, CS
+
+
+def compute_surprisal_fused(seq, tau, order, no_obs=None):
+    """
+    SP, AP and TP surprisal from one encoding of the sequence and one sweep
+        * Evidence of all three models is stacked along the alpha axis so that
+          a single IIR filter forgets the counts of all models at once
+        * seq can be a single sequence or a padded (n_sequences x T) batch
+    Output: Dictionary with PS/BS/CS regressors of all models, e.g. "PS_SP"
+    """
+    seq = seq.astype(int)
+    if no_obs is None:
+        no_obs = np.unique(seq[seq >= 0]).shape[0]
+
+    encodings = [(model_type,) + encode_observations(seq, model_type, order, no_obs)
+                 for model_type in ["SP", "AP", "TP"]]
+    evidence = np.concatenate([evidence_from_observations(ind, valid, int(np.prod(shape)))
+                               for model_type, ind, valid, shape in encodings],
+                              axis=-1)
+    # AP convention for the first trial is applied on its slice below
+    alphas = decayed_alphas(evidence, tau, "SP")
+
+    results = {}
+    start = 0
+    for model_type, ind, valid, shape in encodings:
+        stop = start + int(np.prod(shape))
+        alphas_model = alphas[..., start:stop]
+        # No repetition possible if only 1 obs!
+        if model_type == "AP":
+            alphas_model[..., 0, :] = 1
+        PS, BS, CS = surprisal_from_alphas(alphas_model, ind, shape,
+                                           cached=(tau == 0))
+        for name, surprise in zip(["PS", "BS", "CS"], [PS, BS, CS]):
+            surprise[seq < 0] = np.nan
+            results[name + "_" + model_type] = surprise
+        start = stop
+    return results
+
+
+def main_fused(seq, hidden, tau, order,
+               save_results=False, title="temp", verbose=False):
+    # Compute Surprisal of SP, AP and TP model in a single sweep
+    results = compute_surprisal_fused(seq, tau, order)
+    if verbose:
+        print("SP/AP/TP: Done computing surprisal measures for all {} timesteps.".format(seq.shape[-1]))
 
     if save_results:
-        results_formatted = {"time": time,
-                             "sequence": sequence,
+        results_formatted = {"time": np.arange(seq.shape[-1]),
+                             "sequence": seq,
+                             "hidden": hidden}
+        results_formatted.update(results)
+
+        save_obj(results_formatted, results_dir + title)
+        print("Saved in File: {}".format(results_dir + title))
+    else:
+        return results
+
+
+def main_batch(seqs, tau, model_type, order, no_obs=None, verbose=False):
+    """
+    Compute Surprisal for a batch of sequences (e.g. all blocks of a cohort)
+        * seqs: (n_sequences x T) array or list of ragged sequences
+        * no_obs: alphabet size shared by all sequences (default: all
+          distinct symbols found in the batch)
+    Output: PS, BS, CS as (n_sequences x T_max) arrays, NaN at padding
+    """
+    if isinstance(seqs, np.ndarray) and seqs.ndim == 2:
+        seqs_padded = seqs.astype(int)
+    else:
+        seqs_padded = pad_sequences(seqs)[0]
+
+    PS, BS, CS, alphas = compute_surprisal_vectorized(seqs_padded, tau,
+                                                      model_type, order, no_obs)
+    if verbose:
+        print("{}: Done computing surprisal measures for {} sequences.".format(model_type, seqs_padded.shape[0]))
+    return PS, BS, CS
+
+
+def main_tau_grid(seq, hidden, taus, model_type, order,
+                  save_results=False, title="temp", verbose=False):
+    # Compute Surprisal for all time steps and forgetting params for DirCat Model
+    taus = np.asarray(taus, dtype=float)
+    PS, BS, CS = compute_surprisal_tau_grid(seq, taus, model_type, order)
+    if verbose:
+        print("{}: Done computing surprisal measures for {} taus.".format(model_type, len(taus)))
+
+    if save_results:
+        results_formatted = {"tau": taus,
+                             "time": np.arange(len(seq)),
+                             "sequence": seq,
                              "hidden": hidden,
                              "predictive_surprise": PS,
                              "bayesian_surprise": BS,
@@ -193,6 +635,28 @@ def main(seq, hidden, tau, model_type, order,
     else:
         return PS, BS, CS
 
+
+def main(seq, hidden, tau, model_type, order,
+         save_results=False, title="temp", verbose=False, incremental=True):
+    # Compute Surprisal for all time steps for DirCat Model
+    CD_SBL_temp = SBL_Cat_Dir(seq, hidden, tau, model_type, order, verbose,
+                              incremental)
+    results = CD_SBL_temp.compute_surprisal(max_T=CD_SBL_temp.T, verbose_surprisal=verbose)
+
+    PS = results["predictive_surprise"]
+    BS = results["bayesian_surprise"]
+    CS = results["confidence_corrected_surprise"]
+
+    if save_results:
+        results_formatted = {name: results[name] for name in
+                             ["time", "sequence", "hidden", "predictive_surprise",
+                              "bayesian_surprise", "confidence_corrected_surprise"]}
+
+        save_obj(results_formatted, results_dir + title)
+        print("Saved in File: {}".format(results_dir + title))
+    else:
+        return PS, BS, CS
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-file', '--sample_file', action="store",
@@ -205,9 +669,17 @@ if __name__ == "__main__":
                         type=str,
                         help='Categorical Dirichlet Probability Model (SP, AP, TP)')
     parser.add_argument('-order', '--order', action="store", default=1, type=int,
-                        help='Order for Transition Probability model (1 or 2)')
+                        help='Order for Transition Probability model (any n >= 1)')
     parser.add_argument('-pkl_in', '--pickle', action="store_true", help='Load matlab sequence file.')
     parser.add_argument('-S', '--save', action="store_true", default=False, help='Save results to array.')
+    parser.add_argument('-full', '--full_update', action="store_true", default=False,
+                        help='Recompute posterior from scratch at every trial (O(T^2) reference).')
+    parser.add_argument('-vec', '--vectorized', action="store_true", default=False,
+                        help='Compute surprisal for the whole sequence at once.')
+    parser.add_argument('-fused', '--fused', action="store_true", default=False,
+                        help='Compute SP, AP and TP surprisal in a single sweep.')
+    parser.add_argument('-taus', '--tau_grid', nargs='+', type=float, default=None,
+                        help='Grid of forgetting parameters - (n_tau x T) regressors')
     parser.add_argument('-V', '--verbose',
                         action="store_true",
                         default=False,
@@ -228,6 +700,19 @@ if __name__ == "__main__":
     order = args.order
     v = args.verbose
 
-    main(seq, hidden, tau, model, order,
-         save_results=save_results, title="CD_" + model + "_" + args.sample_file,
-         verbose=v)
+    if args.fused:
+        main_fused(seq, hidden, tau, order, save_results=save_results,
+                   title="CD_" + args.sample_file, verbose=v)
+    elif args.tau_grid is not None:
+        main_tau_grid(seq, hidden, args.tau_grid, model, order,
+                      save_results=save_results,
+                      title="CD_" + model + "_" + args.sample_file + "_tau_grid",
+                      verbose=v)
+    elif args.vectorized:
+        main_vectorized(seq, hidden, tau, model, order,
+                        save_results=save_results,
+                        title="CD_" + model + "_" + args.sample_file, verbose=v)
+    else:
+        main(seq, hidden, tau, model, order,
+             save_results=save_results, title="CD_" + model + "_" + args.sample_file,
+             verbose=v, incremental=not args.full_update)
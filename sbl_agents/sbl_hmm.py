@@ -3,8 +3,21 @@ import argparse
 import numpy as np
 import math
 import random
+from scipy.special import xlogy
+from multiprocessing import Pool
 from hmmlearn import hmm
 from utils.helpers import *
+from sbl_agents.hmm_kernels import forward_backward
+
+# Columns stored per output level - each level extends the previous one
+OUTPUT_LEVELS = {"surprise": ["time", "sequence", "hidden", "predictive_surprise",
+                              "bayesian_surprise", "confidence_corrected_surprise"],
+                 "posteriors": ["states"],
+                 "full": ["state1", "state2", "transmat", "viterbi_state",
+                          "em_iterations"]}
+
+# Weight of init_hmm in the warm-started parameters (keeps them off zero)
+WARM_START_MIX = 1e-3
 
 
 class SBL_HMM():
@@ -15,11 +28,22 @@ class SBL_HMM():
         * She calculates different surprise measures as the events come in
     INPUT: Sequence, catch: inclusion of catch trial, type: estimated statistic (SP,AP,TP),
     n_states: number of latent states of HMM, fix_tm: whether transition matrix is
-    estimated
+    estimated, online: forward-filter the state posterior and update the HMM
+    parameters by stepwise EM instead of refitting on every prefix,
+    warm_start: initialize the refit at trial t with the parameters fitted at
+    t-1, max_iter: EM iteration budget per refit, n_jobs: number of worker
+    processes over which the independent prefix refits are distributed,
+    output: stored columns - "surprise" (default), "posteriors" (+ state
+    posterior) or "full" (+ emission/transition snapshots, Viterbi state, EM
+    iterations) - the Viterbi decoding only runs for "full"
     OUTPUT: Predictive surprisal, Bayesian surprisal, Confidence-corrected surprisal
-    [t, o_t, s_t, Prediction_Surprise, Bayesian_Surprise, Confidence_Corrected_Surprise]
+    Structured array with columns [time, sequence, hidden, predictive_surprise,
+    bayesian_surprise, confidence_corrected_surprise, state1, state2, states,
+    transmat, viterbi_state, em_iterations] - reduced by the output level
     """
-    def __init__(self, seq, hidden, n_states, model_type, fix_tm, catch, order, verbose):
+    def __init__(self, seq, hidden, n_states, model_type, fix_tm, catch, order,
+                 verbose, online=False, warm_start=False, max_iter=20000,
+                 n_jobs=1, output="surprise"):
         # Initialize SBL-learned sequence and exponential forgetting parameter
         self.sequence = seq.astype(int)
         self.catch = catch
@@ -35,78 +59,28 @@ class SBL_HMM():
         self.n_states = n_states
         self.fix_tm = fix_tm
         self.verbose = verbose
+        self.online = online
+        self.warm_start = warm_start
+        self.max_iter = max_iter
+        self.n_jobs = n_jobs
+        if output not in OUTPUT_LEVELS:
+            raise ValueError("Provide right output level (surprise, posteriors, full)")
+        self.output = output
+        if self.warm_start and self.n_jobs > 1:
+            raise ValueError("Warm-started refits depend on the previous fit - use n_jobs=1")
         self.no_obs = np.unique(self.sequence).shape[0]
         self.stim_ind = np.zeros((self.T, self.no_obs))
 
         # Construct matrix where col represents binary ind of specific stim at t
-        for t in range(self.T):
-            self.stim_ind[t, self.sequence[t]] = 1
+        self.stim_ind[np.arange(self.T), self.sequence] = 1
 
         # AP: Generate T-dim vector indicating no-alternation from t-1 to t
         self.repetition = np.zeros(self.T)
-        for t in range(1, self.T):
-            if self.sequence[t] == self.sequence[t-1]:
-                self.repetition[t] = 1
+        self.repetition[1:] = self.sequence[1:] == self.sequence[:-1]
 
         # TP: Generate T-dim vectors indicating transition from state i
-        self.all_transitions = np.zeros(self.T)
-        for t in range(1, self.T):
-            # ALL transitions
-            if self.catch == True:
-                if self.sequence[t-1] == 0 and self.sequence[t] == 0:
-                    self.all_transitions[t] = 0
-                if self.sequence[t-1] == 0 and self.sequence[t] == 1:
-                    self.all_transitions[t] = 1
-                if self.sequence[t-1] == 0 and self.sequence[t] == 2:
-                    self.all_transitions[t] = 2
-                if self.sequence[t-1] == 1 and self.sequence[t] == 0:
-                    self.all_transitions[t] = 3
-                if self.sequence[t-1] == 1 and self.sequence[t] == 1:
-                    self.all_transitions[t] = 4
-                if self.sequence[t-1] == 1 and self.sequence[t] == 2:
-                    self.all_transitions[t] = 5
-                if self.sequence[t-1] == 2 and self.sequence[t] == 0:
-                    self.all_transitions[t] = 6
-                if self.sequence[t-1] == 2 and self.sequence[t] == 1:
-                    self.all_transitions[t] = 7
-                if self.sequence[t-1] == 2 and self.sequence[t] == 2:
-                    self.all_transitions[t] = 8
-                self.number_of_transitions = self.no_obs**2
-
-            elif self.catch == False:
-                # First Order transitions
-                if self.order == 1:
-                    if self.sequence[t-1] == 0 and self.sequence[t] == 0:
-                        self.all_transitions[t] = 0
-                    if self.sequence[t-1] == 0 and self.sequence[t] == 1:
-                        self.all_transitions[t] = 1
-                    if self.sequence[t-1] == 1 and self.sequence[t] == 0:
-                        self.all_transitions[t] = 2
-                    if self.sequence[t-1] == 1 and self.sequence[t] == 1:
-                        self.all_transitions[t] = 3
-                    self.number_of_transitions = self.no_obs**2
-
-                # Second Order transitions
-                elif self.order == 2:
-                    if self.sequence[t-2] == 0 and self.sequence[t-1] == 0 and self.sequence[t] == 0:
-                        self.all_transitions[t] = 0
-                    if self.sequence[t-2] == 0 and self.sequence[t-1] == 0 and self.sequence[t] == 1:
-                        self.all_transitions[t] = 1
-                    if self.sequence[t-2] == 0 and self.sequence[t-1] == 1 and self.sequence[t] == 0:
-                        self.all_transitions[t] = 2
-                    if self.sequence[t-2] == 1 and self.sequence[t-1] == 0 and self.sequence[t] == 0:
-                        self.all_transitions[t] = 3
-                    if self.sequence[t-2] == 0 and self.sequence[t-1] == 1 and self.sequence[t] == 1:
-                        self.all_transitions[t] = 4
-                    if self.sequence[t-2] == 1 and self.sequence[t-1] == 0 and self.sequence[t] == 1:
-                        self.all_transitions[t] = 5
-                    if self.sequence[t-2] == 1 and self.sequence[t-1] == 1 and self.sequence[t] == 0:
-                        self.all_transitions[t] = 6
-                    if self.sequence[t-2] == 1 and self.sequence[t-1] == 1 and self.sequence[t] == 1:
-                        self.all_transitions[t] = 7
-                    self.number_of_transitions = self.no_obs**3
-            else:
-                raise "Order Not Supported (1st or 2nd)"
+        self.all_transitions, self.number_of_transitions = encode_transitions(
+            self.sequence, self.catch, self.order, self.no_obs)
 
         if self.type == "SP":
             self.posterior = np.ones(self.no_obs)/self.no_obs
@@ -137,12 +111,17 @@ class SBL_HMM():
             temp = np.repeat(1./2, 2)
             emissionprob = np.array([[0.49, 0.51], [0.51, 0.49]])
         elif self.type == "TP":
-            if self.catch == False:
-                if self.order == 1:
-                    emissionprob = np.array([[0.49, 0.51, 0.51, 0.49], [0.51, 0.49, 0.49, 0.51]])
-                elif self.order == 2:
-                    emissionprob = np.array([[0.1245, 0.1245, 0.1255, 0.125, 0.1255, 0.1255, 0.125, 0.1245],
-                    [0.1255, 0.1245, 0.1255, 0.125, 0.1245, 0.1245, 0.125, 0.1255]])
+            if self.catch == False and self.order == 1:
+                emissionprob = np.array([[0.245, 0.255, 0.255, 0.245], [0.255, 0.245, 0.245, 0.255]])
+            elif self.catch == False and self.order == 2:
+                emissionprob = np.array([[0.1245, 0.1245, 0.1255, 0.125, 0.1255, 0.1255, 0.125, 0.1245],
+                [0.1255, 0.1245, 0.1255, 0.125, 0.1245, 0.1245, 0.125, 0.1255]])
+            else:
+                # Slightly perturbed uniform emissions over all transitions -
+                # zero-mean perturbation keeps the rows stochastic
+                perturbation = 0.02*(-1)**np.arange(self.number_of_transitions)
+                perturbation -= perturbation.mean()
+                emissionprob = np.array([1 + perturbation, 1 - perturbation])/self.number_of_transitions
 
         if self.fix_tm == False:
             transmat = np.repeat([startprob], self.n_states, axis=0)
@@ -152,6 +131,61 @@ class SBL_HMM():
 
         return startprob, transmat, emissionprob
 
+    def observation_codes(self):
+        """
+        Output: Integer code of the symbol emitted at each trial - stimulus (SP),
+        repetition (AP) or transition (TP)
+        """
+        if self.type == "SP":
+            return self.sequence.astype(int)
+        elif self.type == "AP":
+            return self.repetition.astype(int)
+        elif self.type == "TP":
+            return self.all_transitions.astype(int)
+        else:
+            raise "Provide right model type (SP, AP, TP)"
+
+    def training_sequence(self, t):
+        """
+        Output: Column of observation codes up to trial t preceded by all valid
+        symbols so that every symbol is present in the training data
+        """
+        if self.type == "SP":
+            valid_sample = np.unique(self.sequence)
+            temp = self.sequence[:t+1].reshape(1, -1).T
+
+        elif self.type == "AP":
+            valid_sample = np.array([0, 1])
+            temp = self.repetition[:t+1].reshape(1, -1).T.astype(int)
+
+        elif self.type == "TP":
+            valid_sample = np.arange(self.number_of_transitions)
+            temp = self.all_transitions[:t+1].reshape(1, -1).T.astype(int)
+
+        valid_sample = valid_sample.reshape(1,-1).T
+        return np.vstack((valid_sample, temp))
+
+    def fit_random_restart(self, restart):
+        """
+        Fit the HMM (free transition matrix) on the full sequence from a
+        random initialization seeded by the restart id
+        Output: Log-likelihood, number of free parameters, number of scored
+        observations (incl. the prepended valid symbols) and fitted model
+        """
+        rng = np.random.RandomState(restart)
+        n_symbols = self.posterior.shape[0]
+        model = hmm.MultinomialHMM(n_components=self.n_states, random_state=restart,
+                                   n_iter=self.max_iter, tol=1e-10, init_params="")
+        model.startprob_ = np.repeat(1./self.n_states, self.n_states)
+        model.transmat_ = rng.dirichlet(np.ones(self.n_states), self.n_states)
+        model.emissionprob_ = rng.dirichlet(np.ones(n_symbols), self.n_states)
+
+        valid_seq = self.training_sequence(self.T - 1)
+        model.fit(valid_seq)
+        n_params = (self.n_states - 1 + self.n_states*(self.n_states - 1) +
+                    self.n_states*(n_symbols - 1))
+        return model.score(valid_seq), n_params, len(valid_seq), model
+
     def calc_all_posteriors(self, t, random_state):
         """
         Input: Unique state id transformed data, length per ep trace and HMM inits
@@ -159,9 +193,16 @@ class SBL_HMM():
         - Option: If desired get AIC and BIC for model as well
         """
         startprob, transmat, emissionprob = self.init_hmm()
+        if self.warm_start and t > 0:
+            # Start EM from the parameters fitted on the previous prefix -
+            # mixed with the initialization to leave degenerate (zero) states
+            mix = WARM_START_MIX
+            startprob = (1 - mix)*self.model.startprob_ + mix*startprob
+            transmat = (1 - mix)*self.model.transmat_ + mix*transmat
+            emissionprob = (1 - mix)*self.model.emissionprob_ + mix*emissionprob
 
         # iteration parameters
-        n_iter = 20000
+        n_iter = self.max_iter
         eps = 1e-10
         v = False
 
@@ -176,136 +217,359 @@ class SBL_HMM():
         model.transmat_ = transmat
         model.emissionprob_ = emissionprob
 
-        if self.type == "SP":
-            valid_sample = np.unique(self.sequence)
-            temp = self.sequence[:t+1].reshape(1, -1).T
-            valid_sample = valid_sample.reshape(1,-1).T
-
-        elif self.type == "AP":
-            valid_sample = np.array([0, 1])
-            temp = self.repetition[:t+1].reshape(1, -1).T.astype(int)
-            valid_sample = valid_sample.reshape(1,-1).T
-
-        elif self.type == "TP":
-            valid_sample = np.arange(self.number_of_transitions)
-            temp = self.all_transitions[:t+1].reshape(1, -1).T.astype(int)
-            valid_sample = valid_sample.reshape(1,-1).T
-
-        valid_seq = np.vstack((valid_sample, temp))
+        valid_seq = self.training_sequence(t)
 
         self.model = model.fit(valid_seq)
-        logprob, state_sequence = model.decode(valid_seq)
+        # Viterbi path over the prefix is only a diagnostic
+        if self.output == "full":
+            logprob, state_sequence = model.decode(valid_seq)
+        else:
+            state_sequence = None
         logprob, posteriors = model.score_samples(valid_seq)
 
         return posteriors, state_sequence
 
-    def posterior_predictive(self, posterior):
-        return np.matmul(self.model.emissionprob_.T,
-                         np.matmul(self.model.transmat_.T,
-                                   posterior.T))
+    def fit_prefix(self, t):
+        """
+        Refit the HMM on the prefix up to trial t
+        Output: Last state posterior, last Viterbi state (-1 if not decoded),
+        fitted transition and emission matrices and number of EM iterations
+        """
+        posteriors, state_sequence = self.calc_all_posteriors(t, 1)
+        viterbi_state = -1 if state_sequence is None else state_sequence[-1]
+        return (posteriors[-1], viterbi_state, self.model.transmat_,
+                self.model.emissionprob_, self.model.monitor_.iter)
 
-    def predictive_surprisal(self, posterior, ind):
-        return -np.log(self.posterior_predictive(posterior)[ind])
+    def fit_all_prefixes(self):
+        """
+        Distribute the independent prefix refits over n_jobs processes
+            * Largest prefixes are scheduled first in chunks to balance load
+            * Fits are returned in trial order
+        """
+        schedule = list(range(self.T))[::-1]
+        chunksize = max(1, self.T // (4*self.n_jobs))
+        with Pool(self.n_jobs, initializer=init_prefix_worker, initargs=(self,)) as pool:
+            fits = pool.map(fit_prefix_worker, schedule, chunksize)
+        return fits[::-1]
+
+    def posterior_predictive(self, posterior, transmat=None, emissionprob=None):
+        # Parameters default to the latest fit
+        if transmat is None:
+            transmat = self.model.transmat_
+        if emissionprob is None:
+            emissionprob = self.model.emissionprob_
+        return np.matmul(emissionprob.T, np.matmul(transmat.T, posterior.T))
+
+    def predictive_surprisal(self, posterior, ind, transmat=None, emissionprob=None):
+        return -np.log(self.posterior_predictive(posterior, transmat, emissionprob)[ind])
 
     def bayesian_surprisal(self, posterior_old, posterior):
-        return kl_general(posterior_old, posterior)
+        # Batched over leading dims, e.g. (T x n_states) posteriors
+        return kl_general_batch(posterior_old, posterior)
 
     def corrected_surprisal(self, posterior_old, posterior_naive):
-        return kl_general(posterior_old, posterior_naive)
+        return kl_general_batch(posterior_old, posterior_naive)
+
+    def results_dtype(self):
+        # Named columns of the preallocated results buffer
+        n_symbols = self.posterior.shape[0]
+        columns = [("time", int), ("sequence", int), ("hidden", float),
+                   ("predictive_surprise", float),
+                   ("bayesian_surprise", float),
+                   ("confidence_corrected_surprise", float),
+                   ("state1", float, (n_symbols,)),
+                   ("state2", float, (n_symbols,)),
+                   ("states", float, (self.n_states,)),
+                   ("transmat", float, (self.n_states, self.n_states)),
+                   ("viterbi_state", int),
+                   ("em_iterations", int)]
+        stored = []
+        for level in OUTPUT_LEVELS:
+            stored += OUTPUT_LEVELS[level]
+            if level == self.output:
+                break
+        return np.dtype([column for column in columns if column[0] in stored])
+
+    def store_results(self, results, t, **columns):
+        # Write the columns of trial t that the output level keeps
+        results[t] = tuple(columns[name] for name in results.dtype.names)
 
     def compute_surprisal(self, verbose_surprisal, max_T):
+        if self.online:
+            return self.compute_surprisal_online(verbose_surprisal, max_T)
         print("{}: Computing different surprisal measures for {} timesteps.".format(self.type, max_T))
-        results = []
+        results = np.zeros(self.T, dtype=self.results_dtype())
 
         hmm_init_posterior = np.repeat(1./self.n_states, self.n_states)
+        # Posterior over states before each trial - BS/CS are computed in one call
+        posteriors_old = np.zeros((self.T, self.n_states))
+        posteriors_new = np.zeros((self.T, self.n_states))
+        O_terms = np.zeros(self.T)
+        codes = self.observation_codes()
+        if self.n_jobs > 1:
+            fits = self.fit_all_prefixes()
 
         for t in range(self.T):
             # Loop over the full sequence and compute surprise iteratively
             if t == 0:
                 posterior_old = hmm_init_posterior
+                # Uniform emissions over the alphabet of observation codes
+                n_symbols = len(self.posterior)
+                ep_old = np.ones((self.n_states, n_symbols))/n_symbols
 
-                if self.type == "SP":
-                    ep_old = np.ones([self.n_states, self.no_obs]) / self.no_obs
-                elif self.type == "AP":
-                    ep_old = np.ones([self.n_states, 2]) / 2
-                elif self.type == "TP":
-                    if self.order == 1:
-                        ep_old = np.ones([self.n_states, self.no_obs**2]) / self.no_obs**2
-                    elif self.order == 2:
-                        ep_old = np.ones([self.n_states, self.no_obs**3]) / self.no_obs**3
-
-            posteriors, state_sequence = self.calc_all_posteriors(t, 1)
-            posterior = posteriors[-1]
-
-            if self.type == "SP":
-                ind = int(self.sequence[t])
-            elif self.type == "AP":
-                ind = int(self.repetition[t])
-            elif self.type == "TP":
-                # from and to stimulus transition
-                ind = int(self.all_transitions[t])
+            if self.n_jobs > 1:
+                fit = fits[t]
             else:
-                raise "Provide right model type (SP, AP, TP)"
+                fit = self.fit_prefix(t)
+            posterior, viterbi_state, transmat, emissionprob, n_iter = fit
 
-            PS_temp = self.predictive_surprisal(posterior_old, ind)
-            BS_temp = self.bayesian_surprisal(posterior_old, posterior)
+            # SP: stimulus, AP: repetition, TP: from and to stimulus transition
+            ind = codes[t]
 
-            # CS computation
-            O_term = 0
-            C_term = 0
-            for s in range(self.n_states):
-                O_term += ep_old[s, ind]
-                C_term += posterior_old[s]*np.log(posterior_old[s])
+            PS_temp = self.predictive_surprisal(posterior_old, ind, transmat, emissionprob)
 
-            CS_temp = PS_temp + BS_temp + np.log(O_term) + C_term
+            # CS computation: emission probability of obs summed over states
+            posteriors_old[t] = posterior_old
+            O_terms[t] = ep_old[:, ind].sum()
 
-            # extended output
-            state1_temp = self.model.emissionprob_[0]
-            state2_temp = self.model.emissionprob_[1]
-            states_temp = posteriors[-1]
-            transmat_temp = self.model.transmat_
-
-            posterior_predictive_old = self.posterior_predictive(posterior_old)
+            posteriors_new[t] = posterior
             posterior_old = posterior[:]
-            ep_old = self.model.emissionprob_
+            ep_old = emissionprob
             if verbose_surprisal:
-                print("time:{} --- posterior: {} --- state: {}".format(t, posteriors[-1], state_sequence[-1]))
-                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1, round(PS_temp, 4),  round(BS_temp, 4), round(CS_temp, 4)))
+                print("time:{} --- posterior: {} --- state: {}".format(t, posterior, viterbi_state))
+
+            # extended output
+            self.store_results(results, t, time=t, sequence=self.sequence[t],
+                               hidden=self.hidden[t], predictive_surprise=PS_temp,
+                               bayesian_surprise=0, confidence_corrected_surprise=0,
+                               state1=emissionprob[0], state2=emissionprob[1],
+                               states=posterior, transmat=transmat,
+                               viterbi_state=viterbi_state, em_iterations=n_iter)
+
+        PS = results["predictive_surprise"]
+        BS = self.bayesian_surprisal(posteriors_old, posteriors_new)
+        # 0*log(0) = 0 for states with zero posterior mass
+        C_terms = xlogy(posteriors_old, posteriors_old).sum(axis=1)
+        results["bayesian_surprise"] = BS
+        results["confidence_corrected_surprise"] = PS + BS + np.log(O_terms) + C_terms
+
+        if verbose_surprisal:
+            for t in range(self.T):
+                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1,
+                      round(PS[t], 4), round(BS[t], 4),
+                      round(results["confidence_corrected_surprise"][t], 4)))
+
+        print("{}: Done computing surprisal measures for all {} timesteps.".format(self.type, self.T))
+        return results
+
+    def compute_surprisal_online(self, verbose_surprisal, max_T, kappa=0.6):
+        """
+        Online HMM learner - O(n_states^2) per trial instead of refitting
+            * Normalized forward message (filtered state posterior) is
+              propagated with the current transition/emission estimates
+            * Expected transition/emission counts under the filtered two-slice
+              posterior are tracked by stepwise EM with step size
+              (t+2)^-kappa, kappa in (0.5, 1], and renormalized into the new
+              parameter estimates after every trial
+            * viterbi_state column holds the filtered MAP state
+        """
+        print("{}: Computing different surprisal measures online for {} timesteps.".format(self.type, max_T))
+        results = np.zeros(self.T, dtype=self.results_dtype())
+        startprob, transmat, emissionprob = self.init_hmm()
+        emissionprob = emissionprob/emissionprob.sum(axis=1, keepdims=True)
+        codes = self.observation_codes()
 
-            temp = [t, self.sequence[t], self.hidden[t], PS_temp, BS_temp, CS_temp, state1_temp, state2_temp, states_temp, transmat_temp, state_sequence[-1]]
-            results.append(temp)
+        # Sufficient statistics initialized with the initial parameters
+        trans_stats = startprob[:, np.newaxis]*transmat
+        emission_stats = startprob[:, np.newaxis]*emissionprob
+        posteriors_old = np.zeros((self.T, self.n_states))
+        posteriors_new = np.zeros((self.T, self.n_states))
+        O_terms = np.zeros(self.T)
+        posterior_old = startprob
+
+        for t in range(self.T):
+            ind = codes[t]
+            prior_states = np.matmul(transmat.T, posterior_old)
+            predictive = np.matmul(emissionprob.T, prior_states)
+            results["predictive_surprise"][t] = -np.log(predictive[ind])
+            posteriors_old[t] = posterior_old
+            O_terms[t] = emissionprob[:, ind].sum()
+
+            # Forward filter and two-slice posterior of the latest transition
+            posterior = prior_states*emissionprob[:, ind]/predictive[ind]
+            two_slice = posterior_old[:, np.newaxis]*transmat*emissionprob[:, ind]
+            two_slice /= two_slice.sum()
+
+            # Stepwise EM: move the statistics towards the latest trial
+            step_size = (t + 2.)**(-kappa)
+            emission_stats *= 1 - step_size
+            emission_stats[:, ind] += step_size*posterior
+            emissionprob = emission_stats/emission_stats.sum(axis=1, keepdims=True)
+            if self.fix_tm == False:
+                trans_stats = (1 - step_size)*trans_stats + step_size*two_slice
+                transmat = trans_stats/trans_stats.sum(axis=1, keepdims=True)
+
+            if verbose_surprisal:
+                print("time:{} --- posterior: {} --- state: {}".format(t, posterior, posterior.argmax()))
+
+            self.store_results(results, t, time=t, sequence=self.sequence[t],
+                               hidden=self.hidden[t],
+                               predictive_surprise=results["predictive_surprise"][t],
+                               bayesian_surprise=0, confidence_corrected_surprise=0,
+                               state1=emissionprob[0], state2=emissionprob[1],
+                               states=posterior, transmat=transmat,
+                               viterbi_state=posterior.argmax(), em_iterations=0)
+            posteriors_new[t] = posterior
+            posterior_old = posterior
+
+        PS = results["predictive_surprise"]
+        BS = self.bayesian_surprisal(posteriors_old, posteriors_new)
+        # 0*log(0) = 0 for states with zero posterior mass
+        C_terms = xlogy(posteriors_old, posteriors_old).sum(axis=1)
+        results["bayesian_surprise"] = BS
+        results["confidence_corrected_surprise"] = PS + BS + np.log(O_terms) + C_terms
+
+        if verbose_surprisal:
+            for t in range(self.T):
+                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1,
+                      round(PS[t], 4), round(BS[t], 4),
+                      round(results["confidence_corrected_surprise"][t], 4)))
 
         print("{}: Done computing surprisal measures for all {} timesteps.".format(self.type, self.T))
-        return np.asarray(results)
+        return results
+
+
+def encode_transitions(sequence, catch, order, no_obs):
+    """
+    Vectorized TP symbol encoding of all trials
+        * Code of trial t is the flat index of (seq[t-order], ..., seq[t]) -
+          built from the shared encode_context
+        * Legacy compatibility: lags of the first `order` trials wrap around
+          to the end of the sequence (trial 0 has code 0) and second order
+          keeps the code order 000, 001, 010, 100, 011, 101, 110, 111
+        * Catch trials included: first order transitions between all symbols
+    Output: T-dim vector of transition codes and number of transitions
+    """
+    if catch:
+        order = 1
+    # Symbols absent from the sequence (e.g. no catch trial) still get a code
+    no_obs = max(no_obs, int(sequence.max()) + 1)
+    context = encode_context(sequence, order, no_obs)
+    codes = np.maximum(context, 0)*no_obs + sequence
+    for t in range(1, min(order, len(sequence))):
+        lagged = sequence[np.arange(t - order, t + 1) % len(sequence)]
+        codes[t] = np.ravel_multi_index(tuple(lagged), (no_obs,)*(order + 1))
+    if order == 2 and no_obs == 2:
+        codes = np.array([0, 1, 2, 4, 3, 5, 6, 7])[codes]
+    codes[:1] = 0
+    return codes.astype(float), no_obs**(order + 1)
+
+
+def score_blocks(seqs, model_type, catch, order, startprob, transmat, emissionprob):
+    """
+    Score and filter all blocks of a subject with given HMM parameters in one
+    batched forward/backward call
+    Output: Log-likelihood per block, filtered and smoothed state posteriors
+    (n_blocks x T_max x n_states) - padded trials repeat the last posterior
+    """
+    codes = [SBL_HMM(seq, np.zeros(len(seq)), len(startprob), model_type, False,
+                     catch, order, False).observation_codes() for seq in seqs]
+    padded = -np.ones((len(codes), max([len(code) for code in codes])), dtype=int)
+    for i, code in enumerate(codes):
+        padded[i, :len(code)] = code
+    return forward_backward(padded, startprob, transmat, emissionprob)
+
+
+def init_prefix_worker(agent):
+    # Each worker process keeps its own copy of the agent
+    global prefix_agent
+    prefix_agent = agent
+
+
+def fit_prefix_worker(t):
+    return prefix_agent.fit_prefix(t)
+
+
+def fit_restart_worker(setting):
+    # Model selection task: one restart of one number of states
+    seq, model_type, catch, order, n_states, restart, max_iter = setting
+    agent = SBL_HMM(seq, np.zeros(len(seq)), n_states, model_type, False,
+                    catch, order, False, max_iter=max_iter)
+    log_likelihood, n_params, n_obs, model = agent.fit_random_restart(restart)
+    params = {"startprob": model.startprob_, "transmat": model.transmat_,
+              "emissionprob": model.emissionprob_}
+    return n_states, restart, log_likelihood, n_params, n_obs, params
+
+
+def select_n_states(seq, model_type, catch, order, n_states_grid=range(2, 7),
+                    n_restarts=5, n_jobs=1, max_iter=20000):
+    """
+    Model selection over the number of hidden states
+        * Every (n_states, restart) pair is fitted on the full sequence from a
+          random initialization in one of n_jobs worker processes
+        * The best-likelihood restart is kept for every number of states
+        * BIC penalizes with the number of observations the likelihood is
+          evaluated on
+    Output: Structured array with columns [n_states, restart, log_likelihood,
+    n_params, aic, bic] - one row per number of states - and dict with the
+    fitted startprob, transmat and emissionprob of the best restart per
+    number of states
+    """
+    settings = [(seq, model_type, catch, order, n_states, restart, max_iter)
+                for n_states in n_states_grid for restart in range(n_restarts)]
+    with Pool(n_jobs) as pool:
+        fits = pool.map(fit_restart_worker, settings)
+
+    selection = np.zeros(len(n_states_grid),
+                         dtype=[("n_states", int), ("restart", int),
+                                ("log_likelihood", float), ("n_params", int),
+                                ("aic", float), ("bic", float)])
+    best_params = {}
+    for i, n_states in enumerate(n_states_grid):
+        best = max([fit for fit in fits if fit[0] == n_states], key=lambda fit: fit[2])
+        n_states, restart, log_likelihood, n_params, n_obs, params = best
+        selection[i] = (n_states, restart, log_likelihood, n_params,
+                        2*n_params - 2*log_likelihood,
+                        np.log(n_obs)*n_params - 2*log_likelihood)
+        best_params[n_states] = params
+    return selection, best_params
+
+
+def main_select(seq, model_type, catch, order, n_states_grid, n_restarts,
+                n_jobs, max_iter=20000, save_results=False, title="temp"):
+    # Fit grid of state numbers with random restarts and report AIC/BIC
+    selection, best_params = select_n_states(seq, model_type, catch, order, n_states_grid,
+                                             n_restarts, n_jobs, max_iter)
+    for row in selection:
+        print("{}: n_states={} --- logL={} --- AIC={} --- BIC={}".format(model_type, row["n_states"],
+              round(row["log_likelihood"], 4), round(row["aic"], 4), round(row["bic"], 4)))
+    print("{}: Best number of states by BIC: {}".format(model_type, selection["n_states"][selection["bic"].argmin()]))
+
+    if save_results:
+        results_formatted = {name: selection[name] for name in selection.dtype.names}
+        results_formatted["params"] = {"n_states_{}".format(n_states): params
+                                       for n_states, params in best_params.items()}
+        save_obj(results_formatted, results_dir + title)
+        print("Saved in File: {}".format(results_dir + title))
+    else:
+        return selection, best_params
 
 
 def main(seq, hidden, n_states, model_type, fix_tm, catch, order,
-         save_results, verbose, title="temp"):
+         save_results, verbose, title="temp", online=False,
+         warm_start=False, max_iter=20000, n_jobs=1, output="surprise"):
     # Compute Surprise for all time steps
-    HMM_SBL_temp = SBL_HMM(seq, hidden, n_states, model_type, fix_tm, catch, order, verbose)
+    HMM_SBL_temp = SBL_HMM(seq, hidden, n_states, model_type, fix_tm, catch,
+                           order, verbose, online, warm_start, max_iter,
+                           n_jobs, output)
     results = HMM_SBL_temp.compute_surprisal(verbose, max_T=HMM_SBL_temp.T, )
 
-    time = results[:, 0]
-    sequence = results[:, 1]
-    hidden = results[:, 2]
-    PS = results[:, 3]
-    BS = results[:, 4]
-    CS = results[:, 5]
-    state1 = results[:, 6]
-    state2 = results[:, 7]
-    states = results[:, 8]
-    transmat = results[:, 9]
-
-    results_formatted = {"time": time,
-                         "sequence": sequence,
-                         "hidden": hidden,
-                         "predictive_surprise": PS,
-                         "bayesian_surprise": BS,
-                         "confidence_corrected_surprise": CS,
-                         "state1": state1,
-                         "state2": state2,
-                         "states": states,
-                         "transmat": transmat}
+    PS = results["predictive_surprise"]
+    BS = results["bayesian_surprise"]
+    CS = results["confidence_corrected_surprise"]
+
+    # Columns of the output level - incl. the Viterbi states for "full"
+    results_formatted = {name: results[name] for name in results.dtype.names}
 
     if save_results:
         save_obj(results_formatted, results_dir + title)
@@ -330,7 +594,24 @@ if __name__ == "__main__":
     parser.add_argument('-catch', '--catch_trials', action="store_true", default=False,
                         help='Exclusion (0) or Inclusion (1) of catch trials')
     parser.add_argument('-order', '--order_TP', action="store", default=1, type=int,
-                        help='Order for Transition Probability model (1 or 2)')
+                        help='Order for Transition Probability model (first order with catch trials)')
+    parser.add_argument('-online', '--online', action="store_true", default=False,
+                        help='Forward-filtering learner with stepwise EM (no refits)')
+    parser.add_argument('-warm', '--warm_start', action="store_true", default=False,
+                        help='Initialize EM at trial t with the fit of trial t-1')
+    parser.add_argument('-max_iter', '--max_iter', action="store", default=20000,
+                        type=int, help='EM iteration budget per trial')
+    parser.add_argument('-jobs', '--n_jobs', action="store", default=1,
+                        type=int, help='Number of processes for the prefix refits')
+    parser.add_argument('-output', '--output', action="store", default="surprise",
+                        type=str, help='Stored columns (surprise, posteriors, full)')
+    parser.add_argument('-select', '--select', action="store_true", default=False,
+                        help='Select number of states by AIC/BIC instead')
+    parser.add_argument('-grid', '--n_states_grid', action="store", nargs="+",
+                        default=[2, 3, 4, 5, 6], type=int,
+                        help='Numbers of hidden states compared in selection')
+    parser.add_argument('-restarts', '--n_restarts', action="store", default=5,
+                        type=int, help='Random restarts per number of states')
     parser.add_argument('-pkl_in', '--pickle', action="store_true", help='Load matlab sequence file.')
     parser.add_argument('-V', '--verbose', action="store_true", default=False,
                         help='Get status printed out')
@@ -355,5 +636,12 @@ if __name__ == "__main__":
     v = args.verbose
     s = args.save
 
-    main(seq, hidden, n_states, model, fix_tm, catch, order,
-         save_results=s, verbose=v, title="HMM_" + model + "_" + args.sample_file)
+    if args.select:
+        main_select(seq, model, catch, order, args.n_states_grid,
+                    args.n_restarts, args.n_jobs, args.max_iter,
+                    save_results=s, title="HMM_select_" + model + "_" + args.sample_file)
+    else:
+        main(seq, hidden, n_states, model, fix_tm, catch, order,
+             save_results=s, verbose=v, title="HMM_" + model + "_" + args.sample_file,
+             online=args.online, warm_start=args.warm_start,
+             max_iter=args.max_iter, n_jobs=args.n_jobs, output=args.output)
@@ -0,0 +1,208 @@
+import os
+import argparse
+import numpy as np
+from utils.helpers import *
+from sbl_agents.sbl_hmm import SBL_HMM
+
+
+class SBL_SMC(SBL_HMM):
+    """
+    DESCRIPTION: Sequential Monte Carlo Hidden Markov Model Sequential Learner
+        * Learner parses a categorical sequence previously generated by HHMM
+        * She tracks the hidden regime and the uncertain transition/emission
+          parameters with a particle filter - each particle carries a state and
+          Dirichlet counts of its transitions and emissions
+        * Parameters are rejuvenated from the per-particle Dirichlet posteriors
+          at every trial (Storvik filter), resampling is systematic
+        * She calculates different surprise measures as the events come in
+    INPUT: Sequence, catch: inclusion of catch trial, type: estimated statistic (SP,AP,TP),
+    n_states: number of latent states of HMM, fix_tm: whether transition matrix is
+    estimated, n_particles: number of particles, seed: random seed of the filter
+    OUTPUT: Predictive surprisal, Bayesian surprisal, Confidence-corrected surprisal
+    Structured array with columns [time, sequence, hidden, predictive_surprise,
+    bayesian_surprise, confidence_corrected_surprise, state1, state2, states,
+    transmat, viterbi_state, em_iterations]
+    """
+    def __init__(self, seq, hidden, n_states, model_type, fix_tm, catch, order,
+                 verbose, n_particles=1000, seed=1):
+        # All columns are filled per trial (no Viterbi decoding involved)
+        SBL_HMM.__init__(self, seq, hidden, n_states, model_type, fix_tm,
+                         catch, order, verbose, output="full")
+        startprob, transmat, emissionprob = self.init_hmm()
+        self.n_particles = n_particles
+        self.rng = np.random.RandomState(seed)
+
+        # Dirichlet priors: flat transition rows, emission rows with the
+        # slight asymmetry of init_hmm so that the states can separate
+        self.startprob = startprob
+        self.transmat = transmat
+        self.transition_prior = np.ones((self.n_states, self.n_states))
+        self.emission_prior = (emissionprob.shape[1]*emissionprob /
+                               emissionprob.sum(axis=1, keepdims=True))
+
+    def sample_dirichlet_rows(self, counts):
+        # One draw per Dirichlet row of an (n_particles x rows x K) array
+        draws = self.rng.gamma(counts)
+        return draws/draws.sum(axis=-1, keepdims=True)
+
+    def systematic_resampling(self, weights):
+        # Single uniform offset shared by n_particles evenly spaced positions
+        positions = (self.rng.rand() + np.arange(self.n_particles))/self.n_particles
+        cumulative = np.cumsum(weights)
+        cumulative[-1] = 1.
+        return np.searchsorted(cumulative, positions)
+
+    def compute_surprisal(self, verbose_surprisal, max_T):
+        print("{}: Computing different surprisal measures for {} timesteps.".format(self.type, max_T))
+        results = np.zeros(self.T, dtype=self.results_dtype())
+        codes = self.observation_codes()
+        particles = np.arange(self.n_particles)
+
+        # Particle arrays: state and Dirichlet counts of transitions/emissions
+        states = np.zeros(self.n_particles, dtype=int)
+        transition_counts = np.tile(self.transition_prior, (self.n_particles, 1, 1))
+        emission_counts = np.tile(self.emission_prior, (self.n_particles, 1, 1))
+        weights = np.ones(self.n_particles)/self.n_particles
+
+        # Particle weights before each trial, after it and naive weights (flat
+        # weights updated with the trial) - BS/CS are computed in one call
+        weights_old = np.zeros((self.T, self.n_particles))
+        weights_new = np.zeros((self.T, self.n_particles))
+        weights_naive = np.zeros((self.T, self.n_particles))
+
+        for t in range(self.T):
+            ind = codes[t]
+
+            # Rejuvenate the parameters from the per-particle posteriors
+            emissions = self.sample_dirichlet_rows(emission_counts)
+            if t == 0:
+                prior_states = np.tile(self.startprob, (self.n_particles, 1))
+            elif self.fix_tm == False:
+                prior_states = self.sample_dirichlet_rows(transition_counts[particles, states])
+            else:
+                prior_states = self.transmat[states]
+
+            # Particle predictives of the observation and weight update
+            likelihood = prior_states*emissions[:, :, ind]
+            predictive = likelihood.sum(axis=1)
+            results["predictive_surprise"][t] = -np.log(np.dot(weights, predictive))
+
+            weights_old[t] = weights
+            weights_naive[t] = predictive/predictive.sum()
+            weights = weights*predictive
+            weights /= weights.sum()
+            weights_new[t] = weights
+
+            # Propagate particle states from their filtered distribution
+            cumulative = np.cumsum(likelihood/predictive[:, np.newaxis], axis=1)
+            states_new = (cumulative < self.rng.rand(self.n_particles, 1)).sum(axis=1)
+            states_new = np.minimum(states_new, self.n_states - 1)
+            if t > 0 and self.fix_tm == False:
+                transition_counts[particles, states, states_new] += 1
+            emission_counts[particles, states_new, ind] += 1
+            states = states_new
+
+            # Weighted summaries of the particle cloud
+            posterior = np.bincount(states, weights, self.n_states)
+            emissionprob = np.einsum("p,pij->ij", weights, emission_counts /
+                                     emission_counts.sum(axis=2, keepdims=True))
+            if self.fix_tm == False:
+                transmat = np.einsum("p,pij->ij", weights, transition_counts /
+                                     transition_counts.sum(axis=2, keepdims=True))
+            else:
+                transmat = self.transmat
+
+            if verbose_surprisal:
+                print("time:{} --- posterior: {} --- state: {}".format(t, posterior, posterior.argmax()))
+
+            results[t] = (t, self.sequence[t], self.hidden[t],
+                          results["predictive_surprise"][t], 0, 0,
+                          emissionprob[0], emissionprob[1], posterior,
+                          transmat, posterior.argmax(), 0)
+
+            # Systematic resampling once the effective sample size degenerates
+            if 1./(weights**2).sum() < self.n_particles/2.:
+                idx = self.systematic_resampling(weights)
+                states = states[idx]
+                transition_counts = transition_counts[idx]
+                emission_counts = emission_counts[idx]
+                weights = np.ones(self.n_particles)/self.n_particles
+
+        results["bayesian_surprise"] = self.bayesian_surprisal(weights_old, weights_new)
+        results["confidence_corrected_surprise"] = self.corrected_surprisal(weights_old, weights_naive)
+
+        if verbose_surprisal:
+            for t in range(self.T):
+                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1,
+                      round(results["predictive_surprise"][t], 4),
+                      round(results["bayesian_surprise"][t], 4),
+                      round(results["confidence_corrected_surprise"][t], 4)))
+
+        print("{}: Done computing surprisal measures for all {} timesteps.".format(self.type, self.T))
+        return results
+
+
+def main(seq, hidden, n_states, model_type, fix_tm, catch, order,
+         save_results, verbose, title="temp", n_particles=1000, seed=1):
+    # Compute Surprise for all time steps
+    SMC_SBL_temp = SBL_SMC(seq, hidden, n_states, model_type, fix_tm, catch,
+                           order, verbose, n_particles, seed)
+    results = SMC_SBL_temp.compute_surprisal(verbose, max_T=SMC_SBL_temp.T)
+
+    PS = results["predictive_surprise"]
+    BS = results["bayesian_surprise"]
+    CS = results["confidence_corrected_surprise"]
+
+    results_formatted = {name: results[name] for name in
+                         ["time", "sequence", "hidden", "predictive_surprise",
+                          "bayesian_surprise", "confidence_corrected_surprise",
+                          "state1", "state2", "states", "transmat",
+                          "em_iterations"]}
+
+    if save_results:
+        save_obj(results_formatted, results_dir + title)
+        print("Saved in File: {}".format(results_dir + title))
+    else:
+        return PS, BS, CS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-file', '--sample_file', action="store",
+                        default="temporary_sample_title", type=str,
+                        help='Title of file in which sequence in stored')
+    parser.add_argument('-states', '--n_states', action="store",
+                        default=2, type=int,
+                        help='Number of Hidden States in HMM')
+    parser.add_argument('-model', '--model', action="store", default="SP",
+                        type=str,
+                        help='Categorical Dirichlet Probability Model (SP, AP, TP)')
+    parser.add_argument('-fix_tm', '--fixed_tm', action="store", default=1,
+                        type=int, help='Freely estimated (0) or Fixed (1) transition matrix')
+    parser.add_argument('-catch', '--catch_trials', action="store_true", default=False,
+                        help='Exclusion (0) or Inclusion (1) of catch trials')
+    parser.add_argument('-order', '--order_TP', action="store", default=1, type=int,
+                        help='Order for Transition Probability model (first order with catch trials)')
+    parser.add_argument('-particles', '--n_particles', action="store", default=1000,
+                        type=int, help='Number of particles')
+    parser.add_argument('-seed', '--seed', action="store", default=1,
+                        type=int, help='Random seed of the particle filter')
+    parser.add_argument('-pkl_in', '--pickle', action="store_true", help='Load matlab sequence file.')
+    parser.add_argument('-V', '--verbose', action="store_true", default=False,
+                        help='Get status printed out')
+    parser.add_argument('-S', '--save', action="store_true", default=False,
+                        help='Save results to array.')
+    args = parser.parse_args()
+
+    if args.pickle:
+        sample = load_obj(results_dir + args.sample_file + ".pkl")
+    else:
+        sample = load_obj(results_dir + args.sample_file + ".mat")
+
+    seq = sample[:, 2]
+    hidden = sample[:, 1]
+
+    main(seq, hidden, args.n_states, args.model, args.fixed_tm,
+         args.catch_trials, args.order_TP, save_results=args.save,
+         verbose=args.verbose, title="SMC_" + args.model + "_" + args.sample_file,
+         n_particles=args.n_particles, seed=args.seed)
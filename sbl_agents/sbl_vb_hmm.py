@@ -0,0 +1,197 @@
+import os
+import argparse
+import numpy as np
+from scipy.special import digamma
+from utils.helpers import *
+from sbl_agents.sbl_hmm import SBL_HMM
+
+
+class SBL_VB_HMM(SBL_HMM):
+    """
+    DESCRIPTION: Variational Bayes Hidden Markov Model Sequential Learner
+        * Learner parses a categorical sequence previously generated by HHMM
+        * She keeps Dirichlet posteriors over the rows of the transition and
+          emission matrices and updates them by streaming variational Bayes
+        * She calculates different surprise measures as the events come in
+    INPUT: Sequence, catch: inclusion of catch trial, type: estimated statistic (SP,AP,TP),
+    n_states: number of latent states of HMM, fix_tm: whether transition matrix is
+    estimated
+    OUTPUT: Predictive surprisal, Bayesian surprisal, Confidence-corrected surprisal
+    Structured array with columns [time, sequence, hidden, predictive_surprise,
+    bayesian_surprise, confidence_corrected_surprise, state1, state2, states,
+    transmat, viterbi_state, em_iterations, transition_alphas, emission_alphas]
+    """
+    def __init__(self, seq, hidden, n_states, model_type, fix_tm, catch, order, verbose):
+        # All columns are filled per trial (no Viterbi decoding involved)
+        SBL_HMM.__init__(self, seq, hidden, n_states, model_type, fix_tm,
+                         catch, order, verbose, output="full")
+        startprob, transmat, emissionprob = self.init_hmm()
+        n_symbols = emissionprob.shape[1]
+
+        # Dirichlet priors: flat transition rows, emission rows with the
+        # slight asymmetry of init_hmm so that the states can separate
+        self.startprob = startprob
+        self.transmat = transmat
+        self.transition_prior = np.ones((self.n_states, self.n_states))
+        self.emission_prior = n_symbols*emissionprob/emissionprob.sum(axis=1, keepdims=True)
+
+    def results_dtype(self):
+        # Named columns of the preallocated results buffer
+        columns = SBL_HMM.results_dtype(self).descr
+        columns.append(("transition_alphas", float, self.transition_prior.shape))
+        columns.append(("emission_alphas", float, self.emission_prior.shape))
+        return np.dtype(columns)
+
+    def expected_params(self, alphas):
+        # Geometric means exp(E[ln theta]) of the Dirichlet rows
+        return np.exp(digamma(alphas) - digamma(alphas.sum(axis=1, keepdims=True)))
+
+    def sufficient_statistics(self, posterior_old, transitions, emissions, ind):
+        """
+        Filtered state posterior and expected transition/emission counts that
+        trial with observation ind adds to the Dirichlet posteriors
+        """
+        prior_states = np.matmul(transitions.T, posterior_old)
+        posterior = prior_states*emissions[:, ind]
+        posterior /= posterior.sum()
+
+        # Two-slice posterior of the latest transition
+        two_slice = posterior_old[:, np.newaxis]*transitions*emissions[:, ind]
+        two_slice /= two_slice.sum()
+
+        emission_counts = np.zeros(self.emission_prior.shape)
+        emission_counts[:, ind] = posterior
+        return posterior, two_slice, emission_counts
+
+    def compute_surprisal(self, verbose_surprisal, max_T):
+        print("{}: Computing different surprisal measures for {} timesteps.".format(self.type, max_T))
+        results = np.zeros(self.T, dtype=self.results_dtype())
+        codes = self.observation_codes()
+
+        transition_alphas = self.transition_prior.copy()
+        emission_alphas = self.emission_prior.copy()
+        posterior_old = self.startprob
+
+        # Dirichlet posteriors before each trial and naive posteriors (flat
+        # prior updated with the trial) - BS/CS are computed in one call
+        transition_old = np.zeros((self.T,) + transition_alphas.shape)
+        emission_old = np.zeros((self.T,) + emission_alphas.shape)
+        transition_naive = np.zeros((self.T,) + transition_alphas.shape)
+        emission_naive = np.zeros((self.T,) + emission_alphas.shape)
+
+        for t in range(self.T):
+            ind = codes[t]
+            transition_old[t] = transition_alphas
+            emission_old[t] = emission_alphas
+
+            # Posterior predictive under the posterior mean parameters
+            if self.fix_tm == False:
+                transmat = transition_alphas/transition_alphas.sum(axis=1, keepdims=True)
+                transitions = self.expected_params(transition_alphas)
+            else:
+                transmat = transitions = self.transmat
+            emissionprob = emission_alphas/emission_alphas.sum(axis=1, keepdims=True)
+            predictive = np.matmul(emissionprob.T, np.matmul(transmat.T, posterior_old))
+            results["predictive_surprise"][t] = -np.log(predictive[ind])
+
+            # Variational forward step with the expected log parameters
+            posterior, two_slice, emission_counts = self.sufficient_statistics(
+                posterior_old, transitions, self.expected_params(emission_alphas), ind)
+
+            if self.fix_tm == False:
+                transition_alphas = transition_alphas + two_slice
+                transition_naive[t] = self.transition_prior + two_slice
+            else:
+                transition_naive[t] = transition_alphas
+            emission_alphas = emission_alphas + emission_counts
+            emission_naive[t] = self.emission_prior + emission_counts
+
+            if verbose_surprisal:
+                print("time:{} --- posterior: {} --- state: {}".format(t, posterior, posterior.argmax()))
+
+            emissionprob = emission_alphas/emission_alphas.sum(axis=1, keepdims=True)
+            results[t] = (t, self.sequence[t], self.hidden[t],
+                          results["predictive_surprise"][t], 0, 0,
+                          emissionprob[0], emissionprob[1], posterior,
+                          transition_alphas/transition_alphas.sum(axis=1, keepdims=True),
+                          posterior.argmax(), 0, transition_alphas, emission_alphas)
+            posterior_old = posterior
+
+        # KL between products of independent Dirichlet rows
+        results["bayesian_surprise"] = (
+            kl_dir_batch(transition_old, results["transition_alphas"], 2) +
+            kl_dir_batch(emission_old, results["emission_alphas"], 2))
+        results["confidence_corrected_surprise"] = (
+            kl_dir_batch(transition_old, transition_naive, 2) +
+            kl_dir_batch(emission_old, emission_naive, 2))
+
+        if verbose_surprisal:
+            for t in range(self.T):
+                print("{} - t={}: PS={}, BS={}, CS={}".format(self.type, t+1,
+                      round(results["predictive_surprise"][t], 4),
+                      round(results["bayesian_surprise"][t], 4),
+                      round(results["confidence_corrected_surprise"][t], 4)))
+
+        print("{}: Done computing surprisal measures for all {} timesteps.".format(self.type, self.T))
+        return results
+
+
+def main(seq, hidden, n_states, model_type, fix_tm, catch, order,
+         save_results, verbose, title="temp"):
+    # Compute Surprise for all time steps
+    VB_HMM_SBL_temp = SBL_VB_HMM(seq, hidden, n_states, model_type, fix_tm,
+                                 catch, order, verbose)
+    results = VB_HMM_SBL_temp.compute_surprisal(verbose, max_T=VB_HMM_SBL_temp.T)
+
+    PS = results["predictive_surprise"]
+    BS = results["bayesian_surprise"]
+    CS = results["confidence_corrected_surprise"]
+
+    results_formatted = {name: results[name] for name in
+                         ["time", "sequence", "hidden", "predictive_surprise",
+                          "bayesian_surprise", "confidence_corrected_surprise",
+                          "state1", "state2", "states", "transmat",
+                          "transition_alphas", "emission_alphas"]}
+
+    if save_results:
+        save_obj(results_formatted, results_dir + title)
+        print("Saved in File: {}".format(results_dir + title))
+    else:
+        return PS, BS, CS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-file', '--sample_file', action="store",
+                        default="temporary_sample_title", type=str,
+                        help='Title of file in which sequence in stored')
+    parser.add_argument('-states', '--n_states', action="store",
+                        default=2, type=int,
+                        help='Number of Hidden States in HMM')
+    parser.add_argument('-model', '--model', action="store", default="SP",
+                        type=str,
+                        help='Categorical Dirichlet Probability Model (SP, AP, TP)')
+    parser.add_argument('-fix_tm', '--fixed_tm', action="store", default=1,
+                        type=int, help='Freely estimated (0) or Fixed (1) transition matrix')
+    parser.add_argument('-catch', '--catch_trials', action="store_true", default=False,
+                        help='Exclusion (0) or Inclusion (1) of catch trials')
+    parser.add_argument('-order', '--order_TP', action="store", default=1, type=int,
+                        help='Order for Transition Probability model (first order with catch trials)')
+    parser.add_argument('-pkl_in', '--pickle', action="store_true", help='Load matlab sequence file.')
+    parser.add_argument('-V', '--verbose', action="store_true", default=False,
+                        help='Get status printed out')
+    parser.add_argument('-S', '--save', action="store_true", default=False,
+                        help='Save results to array.')
+    args = parser.parse_args()
+
+    if args.pickle:
+        sample = load_obj(results_dir + args.sample_file + ".pkl")
+    else:
+        sample = load_obj(results_dir + args.sample_file + ".mat")
+
+    seq = sample[:, 2]
+    hidden = sample[:, 1]
+
+    main(seq, hidden, args.n_states, args.model, args.fixed_tm,
+         args.catch_trials, args.order_TP, save_results=args.save,
+         verbose=args.verbose, title="VB_HMM_" + args.model + "_" + args.sample_file)
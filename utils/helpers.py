@@ -10,6 +10,17 @@ import tables
 
 results_dir = os.getcwd() + "/results/"
 
+# Trial sequence files of all blocks per subject
+sample_files = [["sub-01/sub-01_ses-1_run-1", "sub-01/sub-01_ses-1_run-2",
+                 "sub-01/sub-01_ses-1_run-3", "sub-01/sub-01_ses-1_run-4",
+                 "sub-01/sub-01_ses-1_run-5"],
+                ["sub-02/sub-02_ses-1_run-1", "sub-02/sub-02_ses-1_run-2",
+                 "sub-02/sub-02_ses-1_run-3", "sub-02/sub-02_ses-1_run-4",
+                 "sub-02/sub-02_ses-1_run-5"],
+                ["sub-04/sub-04_ses-1_run-1", "sub-04/sub-04_ses-1_run-2",
+                 "sub-04/sub-04_ses-1_run-3", "sub-04/sub-04_ses-1_run-4",
+                 "sub-04/sub-04_ses-1_run-5"]]
+
 
 def standardize(a):
     return (a - np.mean(a))/np.std(a)
@@ -36,6 +47,24 @@ def save_obj(obj, title):
         sio.savemat(f, obj)
 
 
+def save_chunks(chunks, title, chunk_size, attrs={}):
+    """
+    Append the (1 x t x 3) sequence chunks of a generator to a resizable HDF5
+    dataset "sample_output" - memory is bounded by the chunk size
+    """
+    fname = title + ".hdf5"
+    with h5py.File(fname, "w") as h5f:
+        dset = h5f.create_dataset("sample_output", (0, 3), maxshape=(None, 3),
+                                  chunks=(max(chunk_size, 1), 3), dtype=float)
+        for key, value in attrs.items():
+            h5f.attrs[key] = value
+
+        for chunk in chunks:
+            dset.resize(dset.shape[0] + chunk.shape[1], axis=0)
+            dset[-chunk.shape[1]:] = chunk[0]
+    print("Saved in File: {}".format(fname))
+
+
 def load_obj(title, surprise=False):
     """
     Load an object that is either .mat or .pkl file
@@ -74,29 +103,157 @@ def kl_general(p, q):
     """
     if (p == 0.).sum() + (q == 0.).sum() > 0:
         print("Careful: Zero bins found, setting 0 to 1e-200 to proceed")
-        for i in range(len(p)):
-            if p[i] == 0.:
-                p[i] = 1e-200
-            if q[i] == 0.:
-                q[i] = 1e-200
+    return kl_general_batch(p, q)
+
+
+def kl_general_batch(p, q, axis=-1):
+    """
+    KL divergence between batches of discrete distributions along axis
+        * p, q: arrays of equal shape (e.g. N x K) - all other axes are batch
+          dimensions
+        * Zero bins are clipped to 1e-200 on copies, inputs are not modified
+    Output: Array of divergences with axis removed
+    """
+    p = np.where(p == 0., 1e-200, p)
+    q = np.where(q == 0., 1e-200, q)
+    return (p*(np.log(p) - np.log(q))).sum(axis=axis)
+
 
-    return (p*(np.log(p) - np.log(q))).sum()
+# Memoized gammaln/digamma on the half-integer grid 0, 0.5, 1, 1.5, ...
+special_tables = {"gammaln": np.zeros(0), "digamma": np.zeros(0)}
+max_special_table = 2**20
 
 
-def kl_dir(alphas, betas):
+def extend_special_tables(max_arg):
+    """
+    Precompute gammaln/digamma tables for all half-integers up to max_arg
+    (capped at max_special_table entries) - entry k holds the value at k/2
+    """
+    size = min(int(2*max_arg) + 1, max_special_table)
+    if size > len(special_tables["gammaln"]):
+        grid = np.arange(size)/2.
+        special_tables["gammaln"] = gammaln(grid)
+        special_tables["digamma"] = digamma(grid)
+
+
+def lookup_special(name, x, scipy_func):
+    """
+    Serve (half-)integer arguments from the memoized tables - grow the tables
+    geometrically if needed - and fall back to SciPy for any other argument
+    """
+    x = np.asarray(x, dtype=float)
+    grid_idx = 2*x
+    int_idx = grid_idx.astype(np.intp)
+    if x.size == 0 or not np.array_equal(int_idx, grid_idx) or int_idx.min() < 0:
+        return scipy_func(x)
+    if int_idx.max() >= len(special_tables[name]):
+        extend_special_tables(max(int_idx.max(), len(special_tables[name])))
+        if int_idx.max() >= len(special_tables[name]):
+            return scipy_func(x)
+    return special_tables[name].take(int_idx)
+
+
+def gammaln_cached(x):
+    return lookup_special("gammaln", x, gammaln)
+
+
+def digamma_cached(x):
+    return lookup_special("digamma", x, digamma)
+
+
+def kl_dir(alphas, betas, cached=False):
     """
     Compute the KL divergence between two Dirichlet probability distributions
+    cached: serve gammaln/digamma of integer alphas from memoized tables
+    """
+    return kl_dir_batch(alphas, betas, event_ndim=np.ndim(alphas), cached=cached)
+
+
+def kl_dir_batch(alphas, betas, event_ndim=1, cached=False):
+    """
+    KL divergence between batches of Dirichlet distributions
+        * alphas, betas: arrays of equal shape (e.g. N x K) - the last
+          event_ndim axes hold the parameters of one Dirichlet (e.g. 2 for
+          TP tables), all leading axes are batch dimensions
+        * cached: serve gammaln/digamma of integer alphas from memoized tables
+    Output: Array of divergences with the batch shape
+    """
+    lgamma, psi = (gammaln_cached, digamma_cached) if cached else (gammaln, digamma)
+    alphas = np.asarray(alphas, dtype=float)
+    betas = np.asarray(betas, dtype=float)
+    # Flatten the parameters of each Dirichlet into the last axis
+    batch_shape = alphas.shape[:alphas.ndim - event_ndim]
+    alphas = alphas.reshape(batch_shape + (-1,))
+    betas = betas.reshape(batch_shape + (-1,))
+
+    alpha_0 = alphas.sum(axis=-1)
+    beta_0 = betas.sum(axis=-1)
+
+    a_part = lgamma(alpha_0) - lgamma(alphas).sum(axis=-1)
+    b_part = lgamma(beta_0) - lgamma(betas).sum(axis=-1)
+
+    ab_part = ((alphas - betas)*(psi(alphas) -
+                                 psi(alpha_0)[..., np.newaxis])).sum(axis=-1)
+    return a_part - b_part + ab_part
+
+
+def kl_dir_naive_batch(alphas, ind, event_ndim=1, cached=False):
     """
-    alpha_0 = alphas.sum()
-    beta_0 = betas.sum()
+    KL divergence between batches of Dirichlet distributions and the naive
+    posteriors (flat prior + 1 obs at the flat index ind) - the naive alphas
+    are never materialized since all their lnGamma terms are 0
+    Output: Array of divergences with the batch shape
+    """
+    lgamma, psi = (gammaln_cached, digamma_cached) if cached else (gammaln, digamma)
+    alphas = np.asarray(alphas, dtype=float)
+    batch_shape = alphas.shape[:alphas.ndim - event_ndim]
+    alphas = alphas.reshape(batch_shape + (-1,))
+
+    alpha_0 = alphas.sum(axis=-1)
+    psi_part = psi(alphas) - psi(alpha_0)[..., np.newaxis]
+    psi_ind = np.take_along_axis(psi_part, np.asarray(ind)[..., np.newaxis], axis=-1)[..., 0]
+    return (lgamma(alpha_0) - lgamma(alphas).sum(axis=-1) -
+            gammaln(alphas.shape[-1] + 1) +
+            ((alphas - 1)*psi_part).sum(axis=-1) - psi_ind)
+
+
+def kl_dir_sparse(alphas, betas, size, cached=False):
+    """
+    Compute the KL divergence between two large Dirichlet distributions of
+    which only the entries that may differ from 1 are passed (same positions
+    in alphas and betas) - all size - len(alphas) remaining alphas equal 1
+    """
+    lgamma, psi = (gammaln_cached, digamma_cached) if cached else (gammaln, digamma)
+    alpha_0 = size + alphas.sum() - len(alphas)
+    beta_0 = size + betas.sum() - len(betas)
 
-    a_part = gammaln(alpha_0) - (gammaln(alphas)).sum()
-    b_part = gammaln(beta_0) - (gammaln(betas)).sum()
+    # Entries with alpha = beta = 1 contribute zero to all terms
+    a_part = lgamma(alpha_0) - (lgamma(alphas)).sum()
+    b_part = lgamma(beta_0) - (lgamma(betas)).sum()
 
-    ab_part = ((alphas - betas)*(digamma(alphas) - digamma(alpha_0))).sum()
+    ab_part = ((alphas - betas)*(psi(alphas) - psi(alpha_0))).sum()
     return a_part - b_part + ab_part
 
 
+def encode_context(seq, order, no_obs):
+    """
+    Map the previous `order` observations of every trial to a base-no_obs
+    integer (oldest observation most significant) via lagged views of seq
+        * seq can be a single sequence or an (n_sequences x T) batch
+    Output: context index per trial, -1 if less than `order` observations
+    """
+    seq = np.asarray(seq).astype(int)
+    T = seq.shape[-1]
+    context = -np.ones(seq.shape, dtype=int)
+    if order < 1:
+        raise ValueError("Context order has to be at least 1")
+    if T > order:
+        context[..., order:] = 0
+        for lag in range(1, order + 1):
+            context[..., order:] += seq[..., order-lag:T-lag]*no_obs**(lag-1)
+    return context
+
+
 def draw_dirichlet_params(alphas):
     """
     Draw an 8-dim discrete probability array from the Dirichlet distribution